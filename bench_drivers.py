@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Throughput of the HTTP (clickhouse-connect) and native (clickhouse-driver) backends.
+
+Reads the same table through both protocols block by block, the way the
+migration does, keeping the column blocks as streamed, then inserts them
+into a scratch `ENGINE = Null` copy of the table, so insert timings cover
+encoding and transfer but not disk. With --columnar the blocks are inserted
+column-oriented, as the migration does outside partition batching; otherwise
+they are turned into rows first, outside the timed part.
+
+    python bench_drivers.py db.table --prefix SOURCE --limit 5000000 --insert --columnar
+"""
+
+import argparse
+import time
+
+from dotenv import load_dotenv
+
+from ch_migrate import CHMigrateApp, fixed_blocks, make_client
+
+
+def bench_read(client, sql: str) -> tuple[list, list, float]:
+    """Column blocks as the stream yields them; only the read itself is timed."""
+    blocks = []
+    start = time.perf_counter()
+    with client.query_column_block_stream(sql) as stream:
+        column_names = list(stream.source.column_names)
+        for columns in stream:
+            blocks.append(columns)
+    return column_names, blocks, time.perf_counter() - start
+
+
+def bench_insert(client, table: str, column_names, blocks: list, block_rows: int, columnar: bool = False) -> float:
+    # Blocks are cut (and turned into rows for row inserts) before the clock starts
+    if columnar:
+        blocks = list(fixed_blocks(blocks, block_rows))
+    else:
+        rows = [row for columns in blocks for row in zip(*columns)]
+        blocks = [rows[i:i + block_rows] for i in range(0, len(rows), block_rows)]
+    start = time.perf_counter()
+    for block in blocks:
+        client.insert(table=table, data=block, column_names=column_names, column_oriented=columnar)
+    return time.perf_counter() - start
+
+
+def report(label: str, rows: int, row_bytes: float, seconds: float):
+    mb = rows * row_bytes / 1024 / 1024
+    print(f"{label:<16}{rows:>14,}{seconds:>10.2f}{rows / seconds:>16,.0f}{mb / seconds:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("table", help="db.table to read")
+    parser.add_argument("--prefix", default="SOURCE", help=".env prefix of the server (SOURCE / DESTINATION)")
+    parser.add_argument("--http-port", type=int, help="default: 8443 if *_SECURE else 8123")
+    parser.add_argument("--native-port", type=int, help="default: 9440 if *_SECURE else 9000")
+    parser.add_argument("--limit", type=int, default=1_000_000)
+    parser.add_argument("--insert", action="store_true", help="also time inserts into a Null-engine copy")
+    parser.add_argument("--block-rows", type=int, default=65_536)
+    parser.add_argument("--columnar", action="store_true", help="insert column-oriented blocks")
+    args = parser.parse_args()
+
+    load_dotenv()
+    params = CHMigrateApp._load_env_params(args.prefix)
+    db, table = args.table.split(".", 1)
+    full_name = f"`{db}`.`{table}`"
+    scratch = f"`{db}`.`{table}__bench`"
+    sql = f"SELECT * FROM {full_name} LIMIT {args.limit}"
+    backends = [
+        ("http", args.http_port or (8443 if params["secure"] else 8123)),
+        ("native", args.native_port or (9440 if params["secure"] else 9000)),
+    ]
+
+    print(f"{'':<16}{'строк':>14}{'с':>10}{'строк/с':>16}{'МБ/с':>10}")
+    for name, port in backends:
+        client = make_client(dict(params, port=port, driver=name))
+        row_bytes = CHMigrateApp._estimate_row_bytes(client, db, table)
+        column_names, blocks, seconds = bench_read(client, sql)
+        rows = sum(len(columns[0]) for columns in blocks if columns)
+        report(f"{name} read", rows, row_bytes, seconds)
+        if not args.insert:
+            continue
+        client.command(f"CREATE TABLE IF NOT EXISTS {scratch} AS {full_name} ENGINE = Null")
+        try:
+            seconds = bench_insert(client, scratch, column_names, blocks, args.block_rows, args.columnar)
+            report(f"{name} insert", rows, row_bytes, seconds)
+        finally:
+            client.command(f"DROP TABLE IF EXISTS {scratch}")
+
+
+if __name__ == "__main__":
+    main()
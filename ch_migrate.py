@@ -1,25 +1,1166 @@
 #!/usr/bin/env python3
 """ClickHouse Migration Tool — GUI for migrating tables between ClickHouse instances."""
 
+import cProfile
+import hashlib
+import io
 import json
+import mmap
+import operator
 import os
+import pickle
+import queue
+import random
 import re
+import shutil
+import struct
 import subprocess
+import pstats
 import threading
 import time
 import tkinter as tk
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from tkinter import ttk, messagebox, filedialog
 from datetime import date, datetime, timedelta
-from typing import Optional
+from typing import Optional, Sequence
 
 import clickhouse_connect
+import lz4.frame
+from clickhouse_connect.driver.exceptions import DataError, ProgrammingError
 from dotenv import load_dotenv
 
+try:
+    import clickhouse_driver
+except ImportError:  # optional: only needed for the native protocol ports
+    clickhouse_driver = None
+
 CHECKED = "\u2611"
 UNCHECKED = "\u2610"
 WINDOW_TITLE = "ClickHouse Migration Tool"
 WINDOW_SIZE = "1400x900"
+# Ports served over the native TCP protocol (clickhouse-driver); everything else is HTTP
+NATIVE_PORTS = (9000, 9440)
 CONNECTIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "connections.json")
+STAGING_SUFFIX = "__staging"
+PARTITION_COLUMN = "__partition"
+SHARD_COLUMN = "__shard"
+PROFILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles")
+SPILL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "spill")
+# Spill segment files roll over at this size and are deleted once drained
+SPILL_SEGMENT_BYTES = 64 * 1024 * 1024
+SPILL_RECORD_HEADER = struct.Struct("<Q")
+# Times a spill writer resumes from its cursor after a block failed all insert retries
+SPILL_WRITER_RESTARTS = 3
+# Passthrough copies forward the source result to the insert without decoding it
+PASSTHROUGH_FORMAT = "Native"
+PASSTHROUGH_CHUNK_BYTES = 1024 * 1024
+# ClickHouse appends an error after status 200 at the end of the body; v25.11+ tags it
+EXCEPTION_TAG_HEADER = "X-ClickHouse-Exception-Tag"
+PASSTHROUGH_TAIL_BYTES = 64 * 1024
+# Stage of a run's query (read / ins / ddl, see stage_query_id) in system.query_log
+QUERY_STAGE_SQL = "extract(query_id, '^chm-[0-9a-f]+-([a-z]+)-')"
+# Max concurrent DDL statements executed within one dependency wave
+DDL_PARALLELISM = 8
+DDL_WAVE_MARKER = "-- WAVE"
+# Blocks a fan-out destination may fall behind the source reader before it blocks
+DEFAULT_FANOUT_MAX_LAG = 8
+PROGRESS_LOG_INTERVAL = 5.0
+# Per-table column transforms, pushed down into the source SELECT
+TRANSFORM_OPS = ("keep", "drop", "rename", "hash", "null", "constant", "cast")
+# Tunables of the "Параметры..." dialog: key -> (label, default); type follows the default
+MIGRATION_OPTIONS = {
+    "max_parallel": ("Макс. параллельных потоков копирования", 8),
+    "range_splits": ("Диапазонов по ключу сортировки", 4),
+    "range_split_min_rows": ("Делить таблицы от (строк)", 10_000_000),
+    "staging": ("Загрузка через staging-таблицу + EXCHANGE TABLES", False),
+    "defer_indexes": ("Отложить INDEX/PROJECTION до окончания загрузки", False),
+    "partition_batching": ("Вставка блоками по одной партиции", False),
+    "partition_batch_rows": ("Строк в блоке партиции", 100_000),
+    "partition_buffer_rows": ("Буфер партиций на поток (строк)", 1_000_000),
+    "profile": ("Профилирование (отчёт в profiles/)", False),
+    "profile_table": ("cProfile + tracemalloc для таблицы (db.table)", ""),
+    "job_timeout": ("Таймаут задачи, мин (0 — без ограничения)", 0),
+    "spill": ("Буфер на диске (spill) между source и destination", False),
+    "spill_max_mb": ("Лимит spill на поток и destination, МБ", 4096),
+    "shard_reads": ("Distributed source: читать локальные таблицы шардов", True),
+    "shard_writes": ("Distributed destination: вставка напрямую в шарды", True),
+    "passthrough": ("Native passthrough: копировать байты без декодирования", False),
+    "schema_diff": ("DDL: ALTER существующих таблиц вместо пересоздания", False),
+    "ordered_reads": ("Детерминированный порядок чтения (безопасный повтор)", False),
+}
+# Server settings of the source read profile (empty value = server default)
+SOURCE_READ_SETTINGS = ("max_threads", "max_network_bandwidth", "priority", "max_memory_usage")
+THROTTLE_LIMITS = (("rows", "Строк/с"), ("mb", "МБ/с"), ("queries", "Запросов"))
+# Block insert retries: exponential backoff with full jitter
+INSERT_RETRIES = 5
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+# Whole key-range / table unit retries (source read failures)
+RANGE_RETRIES = 3
+# Rows per block of an ordered read (blocks end where the key changes), so a retried unit resends the same blocks
+ORDERED_BLOCK_ROWS = 65536
+# SQL pieces that never hold a column reference (comments, string literals) and identifiers
+SQL_TOKEN = re.compile(r"(?P<skip>--[^\n]*|/\*.*?\*/|'(?:[^'\\]|\\.)*')|`(?P<quoted>(?:[^`\\]|\\.)*)`"
+                       r"|\b(?P<word>[A-Za-z_]\w*)\b", re.S)
+# Replicas probed at once when choosing the least-loaded replica of every shard
+CLUSTER_PROBE_PARALLELISM = 16
+JOB_STATES = {
+    "queued": "в очереди",
+    "running": "выполняется",
+    "done": "завершена",
+    "failed": "ошибка",
+    "cancelled": "отменена",
+    "timeout": "таймаут",
+}
+
+
+def dedup_token(*parts) -> str:
+    """Deterministic insert_deduplication_token from table / unit / block index."""
+    return hashlib.sha1("|".join(map(str, parts)).encode("utf-8")).hexdigest()
+
+
+def stage_query_id(prefix: str, stage: str, *parts) -> str:
+    """query_id for one stage of a run: chm-<run>-<stage>-<unit>-<parts>-<random>.
+
+    `prefix` is chm-<run> or chm-<run>-<unit>. The stage always follows the
+    run id, so system.query_log can be grouped by it (see QUERY_STAGE_SQL)
+    whatever comes after; DDL queries have no unit.
+    """
+    fields = prefix.split("-", 2)
+    return "-".join(fields[:2] + [stage] + fields[2:] + [str(part) for part in parts] + [uuid.uuid4().hex[:6]])
+
+
+class JobCancelled(Exception):
+    """Raised inside a job once it has been cancelled or has timed out."""
+
+
+class UnsafeRetry(Exception):
+    """A failed attempt already wrote rows that a retry could lose or duplicate."""
+
+
+def call_with_retry(fn, what: str, log, attempts: int = INSERT_RETRIES, job: Optional["Job"] = None):
+    """Call fn(), retrying failures with exponential backoff and full jitter.
+
+    Client-side data errors are raised immediately: resending the same block
+    cannot fix them. Nor is anything retried once `job` is cancelled, since
+    the failure is most likely our own KILL QUERY, or after an UnsafeRetry.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return fn()
+        except (DataError, ProgrammingError, JobCancelled, UnsafeRetry):
+            raise
+        except Exception as e:
+            if job is not None:
+                job.check()
+            if attempt == attempts:
+                raise
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+            log(f"{what}: попытка {attempt}/{attempts} не удалась ({e}), повтор через {delay:.1f} с", "WARN")
+            if job is None:
+                time.sleep(delay)
+            elif job.wait(delay):
+                job.check()
+
+
+class TokenBucket:
+    """Thread-safe token bucket; rate 0 means unlimited and can change at any time.
+
+    Consumers may overdraw the bucket (a block is larger than one second of
+    budget) and then wait until it refills, so the long-run rate is exact.
+    """
+
+    def __init__(self, rate: float = 0.0):
+        self._lock = threading.Lock()
+        self.rate = float(rate)
+        self._tokens = self.rate
+        self._stamp = time.monotonic()
+
+    def set_rate(self, rate: float):
+        with self._lock:
+            self._refill()
+            self.rate = float(rate)
+            self._tokens = min(self._tokens, self.rate)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.rate, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def consume(self, amount: float):
+        with self._lock:
+            if self.rate <= 0:
+                return
+            self._refill()
+            self._tokens -= amount
+        while True:
+            with self._lock:
+                if self.rate <= 0:
+                    self._tokens = 0.0
+                    return
+                self._refill()
+                if self._tokens >= 0:
+                    return
+                wait = -self._tokens / self.rate
+            # Short sleeps so a rate change from the GUI takes effect quickly
+            time.sleep(min(wait, 0.5))
+
+
+class Throttle:
+    """Source read limits: rows/s, bytes/s and concurrent queries."""
+
+    def __init__(self):
+        self.rows = TokenBucket()
+        self.bytes = TokenBucket()
+        self.max_queries = 0
+        self._active = 0
+        self._cond = threading.Condition()
+
+    def configure(self, rows_per_sec: float = 0, mb_per_sec: float = 0, max_queries: int = 0):
+        self.rows.set_rate(rows_per_sec)
+        self.bytes.set_rate(mb_per_sec * 1024 * 1024)
+        with self._cond:
+            self.max_queries = int(max_queries)
+            self._cond.notify_all()
+
+    @contextmanager
+    def query_slot(self):
+        with self._cond:
+            while self.max_queries > 0 and self._active >= self.max_queries:
+                self._cond.wait(0.5)
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._cond.notify_all()
+
+    def consume(self, rows: int, nbytes: float):
+        self.rows.consume(rows)
+        self.bytes.consume(nbytes)
+
+
+class StageProfiler:
+    """Thread-safe named timers for the copy pipeline; no-op when disabled."""
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._stages: dict[str, list] = {}
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float, count: int = 1):
+        with self._lock:
+            entry = self._stages.setdefault(name, [0, 0.0])
+            entry[0] += count
+            entry[1] += seconds
+
+    def report(self) -> str:
+        wall = time.perf_counter() - self._started
+        lines = [f"{'Стадия':<24}{'вызовов':>10}{'всего, с':>12}{'сред., мс':>12}{'% wall':>9}"]
+        with self._lock:
+            stages = sorted(self._stages.items(), key=lambda kv: -kv[1][1])
+        for name, (count, total) in stages:
+            lines.append(f"{name:<24}{count:>10}{total:>12.3f}{total / count * 1000:>12.2f}"
+                         f"{total / wall * 100 if wall else 0:>9.1f}")
+        lines.append(f"Wall time: {wall:.3f} с (стадии параллельных потоков суммируются)")
+        return "\n".join(lines)
+
+
+class PartitionBatcher:
+    """Regroups rows so every emitted block belongs to a single partition.
+
+    A bucket is emitted when it reaches `batch_rows`; when all buckets together
+    exceed `buffer_rows` the largest one is emitted early, which bounds memory.
+    """
+
+    def __init__(self, emit, batch_rows: int, buffer_rows: int):
+        self._emit = emit
+        self.batch_rows = max(1, batch_rows)
+        self.buffer_rows = max(self.batch_rows, buffer_rows)
+        self._buckets: dict = {}
+        self._buffered = 0
+
+    def add(self, rows, partitions):
+        for partition, row in zip(partitions, rows):
+            bucket = self._buckets.setdefault(partition, [])
+            bucket.append(row)
+            self._buffered += 1
+            if len(bucket) >= self.batch_rows:
+                self._flush(partition)
+        while self._buffered > self.buffer_rows:
+            self._flush(max(self._buckets, key=lambda p: len(self._buckets[p])))
+
+    def finish(self):
+        for partition in list(self._buckets):
+            self._flush(partition)
+
+    def _flush(self, partition):
+        rows = self._buckets.pop(partition)
+        self._buffered -= len(rows)
+        self._emit(rows)
+
+
+def fixed_blocks(blocks, size: int, key: Sequence[int] = ()):
+    """Re-cut a stream of column blocks into blocks of about `size` rows.
+
+    Server block boundaries vary between runs of the same query; these do
+    not, as long as the row order is fixed. With `key` (column indexes the
+    stream is ordered by) a block is only cut where the key changes, so
+    rows with equal keys, whose order the server does not fix, always land
+    in the same block: each block holds the same rows on every run.
+    Streamed columns are only copied when rows of two streamed blocks have
+    to be joined: a streamed block that is exactly one output block (with
+    `key`, once the next block shows the key run ends there) is passed on
+    as it is, and larger ones are sliced.
+    """
+    pending: Optional[list] = None
+    owned = False  # pending holds lists built here, not the stream's own sequences
+    for columns in blocks:
+        if not columns or not len(columns[0]):
+            continue
+        if (pending is not None and key and len(pending[0]) >= size
+                and [columns[i][0] for i in key] != [pending[i][-1] for i in key]):
+            # The held rows end a key run exactly where this block starts
+            yield pending
+            pending = None
+        if pending is None:
+            current = columns
+        else:
+            current = pending if owned else [list(column) for column in pending]
+            for target, column in zip(current, columns):
+                target.extend(column)
+        rows = len(current[0])
+        start = 0
+        while rows - start >= size:
+            end = _key_run_end(current, key, start + size) if key else start + size
+            if end is None:
+                break
+            yield current if end - start == rows else [column[start:end] for column in current]
+            start = end
+        owned = current is not columns
+        if start == rows:
+            pending = None
+        else:
+            pending = [column[start:] for column in current] if start else current
+        # Drop the emitted rows now, not when the next block arrives
+        current = None
+    if pending:
+        yield pending
+
+
+def _key_run_end(columns: list[list], key: Sequence[int], end: int) -> Optional[int]:
+    """First row at or after `end` whose key differs from row end-1, None if the run reaches the end."""
+    last = [columns[i][end - 1] for i in key]
+    rows = len(columns[0])
+    while end < rows and [columns[i][end] for i in key] == last:
+        end += 1
+    return end if end < rows else None
+
+
+def http_client(params: dict):
+    """clickhouse-connect client (HTTP/HTTPS, ports 8123/8443)."""
+    secure = params.get("secure", False)
+    ca_cert = params.get("ca_cert", "")
+
+    kwargs = dict(
+        host=params.get("host", "localhost"),
+        port=int(params.get("port", 8123)),
+        username=params.get("user", "default"),
+        password=params.get("password", ""),
+        database=params.get("database", "default"),
+    )
+    if secure:
+        kwargs["secure"] = True
+    if ca_cert and os.path.isfile(ca_cert):
+        kwargs["ca_cert"] = ca_cert
+    elif secure:
+        kwargs["verify"] = False
+
+    return clickhouse_connect.get_client(**kwargs)
+
+
+def native_client(params: dict):
+    """NativeClient over clickhouse-driver (native TCP, ports 9000/9440)."""
+    if clickhouse_driver is None:
+        raise RuntimeError("Для портов 9000/9440 нужен пакет clickhouse-driver: "
+                           "pip install clickhouse-driver[lz4]")
+    secure = params.get("secure", False)
+    ca_cert = params.get("ca_cert", "")
+
+    kwargs = dict(
+        host=params.get("host", "localhost"),
+        port=int(params.get("port", 9000)),
+        user=params.get("user", "default"),
+        password=params.get("password", ""),
+        database=params.get("database", "default"),
+        compression="lz4",
+        client_name="ch_migrate",
+    )
+    if secure:
+        kwargs["secure"] = True
+        if ca_cert and os.path.isfile(ca_cert):
+            kwargs["ca_certs"] = ca_cert
+        else:
+            kwargs["verify"] = False
+
+    return NativeClient(clickhouse_driver.Client(**kwargs))
+
+
+# Client backends by name; every backend provides the subset of the
+# clickhouse-connect client API used here: command, query, insert and
+# query_column_block_stream.
+CLIENT_DRIVERS = {"http": http_client, "native": native_client}
+
+
+def make_client(params: dict):
+    """Client for connection params; the backend follows the port unless `driver` is set."""
+    driver = params.get("driver") or ("native" if int(params.get("port", 8123)) in NATIVE_PORTS else "http")
+    return CLIENT_DRIVERS[driver](params)
+
+
+class NativeQueryResult:
+    """The parts of clickhouse-connect's QueryResult the app reads."""
+
+    def __init__(self, rows: list, columns_with_types: list):
+        self.result_rows = rows
+        self.column_names = tuple(name for name, _ in columns_with_types)
+
+
+class NativeBlockStream:
+    """Column blocks of a running native query, shaped like clickhouse-connect's
+    StreamContext: `source.column_names` and iteration over lists of columns.
+
+    The first block the server sends is an empty header carrying the column
+    names; empty blocks are skipped after that.
+    """
+
+    def __init__(self, packets):
+        self._packets = packets
+        self.source = self
+        self.column_names: tuple = ()
+        self.done = False
+        self._pending = self._next_block()
+        if self._pending is not None:
+            self.column_names = tuple(name for name, _ in self._pending.columns_with_types)
+
+    def _next_block(self):
+        for packet in self._packets:
+            block = getattr(packet, "block", None)
+            if block is not None and block.columns_with_types:
+                return block
+        self.done = True
+        return None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> list:
+        block, self._pending = self._pending, None
+        while block is None or not block.num_rows:
+            if self.done:
+                raise StopIteration
+            block = self._next_block()
+        return block.get_columns()
+
+
+class NativeClient:
+    """clickhouse-driver Client behind the clickhouse-connect API used by the app.
+
+    Data travels as native column blocks with LZ4 compression. `query_id`
+    is accepted in settings, as with clickhouse-connect, and passed through
+    as the native query id. Like clickhouse-connect it connects right away
+    and exposes `server_version`.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self.server_version = str(self.command("SELECT version()"))
+
+    @staticmethod
+    def _split_settings(settings: Optional[dict]) -> tuple[dict, Optional[str]]:
+        settings = dict(settings or {})
+        return settings, settings.pop("query_id", None)
+
+    def _execute(self, query: str, parameters=None, settings=None, **kwargs):
+        settings, query_id = self._split_settings(settings)
+        return self._client.execute(query, parameters or None, settings=settings,
+                                    query_id=query_id, **kwargs)
+
+    def command(self, cmd: str, parameters=None, settings: Optional[dict] = None):
+        rows = self._execute(cmd, parameters, settings)
+        if len(rows) == 1 and len(rows[0]) == 1:
+            return rows[0][0]
+        return rows
+
+    def query(self, query: str, parameters=None, settings: Optional[dict] = None) -> NativeQueryResult:
+        rows, columns = self._execute(query, parameters, settings, with_column_types=True)
+        return NativeQueryResult(rows, columns)
+
+    def insert(self, table: str, data, column_names, settings: Optional[dict] = None,
+               column_oriented: bool = False):
+        columns = ", ".join(f"`{name}`" for name in column_names)
+        self._execute(f"INSERT INTO {table} ({columns}) VALUES", data, settings, columnar=column_oriented)
+
+    @contextmanager
+    def query_column_block_stream(self, query: str, settings: Optional[dict] = None):
+        settings, query_id = self._split_settings(settings)
+        client = self._client
+        with client.disconnect_on_error(query, settings):
+            client.connection.send_query(query, query_id=query_id)
+            client.connection.send_external_tables(None)
+            stream = NativeBlockStream(client.packet_generator())
+            try:
+                yield stream
+            finally:
+                # Abandoned mid-result: drop the connection instead of draining it
+                if not stream.done:
+                    client.disconnect()
+
+
+class ConnectionPool:
+    """Connections handed out to one worker thread at a time, opened on demand.
+
+    A clickhouse-connect client keeps one HTTP session, so concurrent queries
+    must go through different clients.
+    """
+
+    def __init__(self, factory, initial=()):
+        self._factory = factory
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        for conn in initial:
+            self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._factory()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+
+class SpillQueue:
+    """Disk-backed FIFO of row blocks between the source reader and one writer.
+
+    put() appends LZ4-compressed blocks to segment files that roll over at
+    `segment_bytes`; the reader maps segments with mmap. Segments are deleted
+    once every block in them is acknowledged, and put() waits while the
+    unacknowledged data exceeds `max_bytes` (files on disk can exceed it by
+    the drained segment the reader is still in).
+
+    ack() persists the read position in a cursor file, so a restarted reader
+    continues from the last acknowledged block via rewind(). Only one thread
+    may put and one may read.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, segment_bytes: int = SPILL_SEGMENT_BYTES):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max(1, max_bytes)
+        self.segment_bytes = max(1, min(segment_bytes, self.max_bytes // 4))
+        self._cond = threading.Condition()
+        self._sizes: dict[int, int] = {}  # segment -> bytes written, for segments still on disk
+        self._write_segment = -1
+        self._file = None
+        self._closed = False
+        self._aborted = False
+        self._pos = (0, 0, 0)  # reader: segment, offset, block index
+        self._acked = (0, 0)  # segment, offset of the last ack()
+        self._map: Optional[mmap.mmap] = None
+        self._map_segment = -1
+        self._cursor_path = os.path.join(directory, "cursor.json")
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:06d}.seg")
+
+    def _pending_bytes(self) -> int:
+        segment, offset = self._acked
+        return sum(size for s, size in self._sizes.items() if s >= segment) - offset
+
+    def put(self, rows: list):
+        payload = lz4.frame.compress(pickle.dumps(rows, protocol=pickle.HIGHEST_PROTOCOL))
+        record = SPILL_RECORD_HEADER.pack(len(payload)) + payload
+        with self._cond:
+            # A record larger than the cap still goes through once everything is acknowledged
+            while not self._aborted and 0 < self._pending_bytes() and \
+                    self._pending_bytes() + len(record) > self.max_bytes:
+                self._cond.wait(0.5)
+            if self._aborted:
+                return
+            if self._file is None or self._sizes[self._write_segment] + len(record) > self.segment_bytes:
+                if self._file is not None:
+                    self._file.close()
+                self._file = open(self._path(self._write_segment + 1), "ab")
+                self._sizes[self._write_segment + 1] = 0
+                self._write_segment += 1
+        # Only this thread writes; the reader never looks past the size recorded below
+        self._file.write(record)
+        self._file.flush()
+        with self._cond:
+            self._sizes[self._write_segment] += len(record)
+            self._cond.notify_all()
+
+    def get(self) -> Optional[tuple[int, list]]:
+        """Next (block index, rows); None once the input is closed and fully read."""
+        with self._cond:
+            while True:
+                segment, offset, index = self._pos
+                if offset < self._sizes.get(segment, 0):
+                    break
+                if segment < self._write_segment:
+                    self._pos = (segment + 1, 0, index)
+                    continue
+                if self._closed or self._aborted:
+                    return None
+                self._cond.wait(0.5)
+        start = offset + SPILL_RECORD_HEADER.size
+        (length,) = SPILL_RECORD_HEADER.unpack_from(self._mapped(segment, start), offset)
+        data = self._mapped(segment, start + length)[start:start + length]
+        self._pos = (segment, start + length, index + 1)
+        return index, pickle.loads(lz4.frame.decompress(data))
+
+    def _mapped(self, segment: int, size: int) -> mmap.mmap:
+        """Map of the segment covering at least `size` bytes; remapped as the file grows."""
+        if self._map_segment != segment or len(self._map) < size:
+            self._unmap()
+            with open(self._path(segment), "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._map_segment = segment
+        return self._map
+
+    def _unmap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map, self._map_segment = None, -1
+
+    def ack(self):
+        """Mark everything read so far as done; drained segments are deleted."""
+        segment, offset, index = self._pos
+        with self._cond:
+            for done in [s for s in self._sizes if s < segment]:
+                if self._map_segment == done:
+                    self._unmap()
+                os.remove(self._path(done))
+                del self._sizes[done]
+            self._acked = (segment, offset)
+            self._cond.notify_all()
+        tmp = self._cursor_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"segment": segment, "offset": offset, "block": index}, f)
+        os.replace(tmp, self._cursor_path)
+
+    def rewind(self):
+        """Resume reading at the last acknowledged block recorded on disk."""
+        cursor = {"segment": 0, "offset": 0, "block": 0}
+        if os.path.isfile(self._cursor_path):
+            with open(self._cursor_path, encoding="utf-8") as f:
+                cursor = json.load(f)
+        self._pos = (cursor["segment"], cursor["offset"], cursor["block"])
+
+    def close(self):
+        """No more blocks will be put."""
+        with self._cond:
+            if self._file is not None:
+                self._file.close()
+            self._closed = True
+            self._cond.notify_all()
+
+    def abort(self):
+        """The reader gave up: drop further blocks instead of making put() wait."""
+        with self._cond:
+            self._aborted = True
+            self._cond.notify_all()
+
+    def remove(self):
+        self._unmap()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class ReplicaPool:
+    """Connections to the replicas of one shard, preferred replica first.
+
+    Same interface as ConnectionPool. When the body of connection() fails,
+    the replica goes to the back of the list and its idle connections are
+    dropped, so the retry of the failed read goes to the next replica.
+    acquire()/release() hold a connection outside a with block, so errors
+    of unrelated code around it do not demote the replica.
+    """
+
+    def __init__(self, replicas: list[tuple[str, dict]], factory, log, initial: Optional[dict] = None):
+        self._replicas = list(replicas)
+        self._factory = factory
+        self._log = log
+        self._lock = threading.Lock()
+        self._idle: dict[str, list] = {host: [conn] for host, conn in (initial or {}).items()}
+
+    @property
+    def replicas(self) -> list[tuple[str, dict]]:
+        with self._lock:
+            return list(self._replicas)
+
+    def acquire(self) -> tuple[str, object]:
+        """(host, connection) of the preferred replica; hand it back with release()."""
+        with self._lock:
+            host, params = self._replicas[0]
+            idle = self._idle.setdefault(host, [])
+            conn = idle.pop() if idle else None
+        if conn is None:
+            try:
+                conn = self._factory(params)
+            except Exception:
+                self._demote(host)
+                raise
+        return host, conn
+
+    def release(self, host: str, conn, failed: bool = False):
+        """Return a connection; a `failed` one is dropped and its replica demoted."""
+        if failed:
+            self._demote(host)
+            return
+        with self._lock:
+            self._idle.setdefault(host, []).append(conn)
+
+    @contextmanager
+    def connection(self):
+        host, conn = self.acquire()
+        try:
+            yield conn
+        except JobCancelled:
+            raise
+        except Exception:
+            self.release(host, conn, failed=True)
+            raise
+        self.release(host, conn)
+
+    def _demote(self, host: str):
+        with self._lock:
+            if len(self._replicas) < 2 or self._replicas[0][0] != host:
+                return
+            self._replicas.append(self._replicas.pop(0))
+            self._idle.pop(host, None)
+            fallback = self._replicas[0][0]
+        self._log(f"  Реплика {host} недоступна, чтение переключено на {fallback}", "WARN")
+
+
+class DestinationWriter:
+    """Inserts blocks into one destination table from a background thread.
+
+    Blocks arrive through a bounded queue whose size is the allowed lag behind
+    the source reader: a slow destination only holds the reader back once it
+    is `max_lag` blocks behind, and a failed one keeps draining its queue
+    without inserting, so the other destinations carry on.
+
+    With a `spill` queue blocks go to disk instead, so the reader is only held
+    back by the spill size cap; a block that fails all retries restarts the
+    writer from the spill cursor, up to SPILL_WRITER_RESTARTS times.
+
+    Every block is inserted with insert_deduplication_token derived from
+    `token_prefix` and the block index and retried on failure, so a resent
+    block that was in fact committed is deduplicated by the server.
+
+    With `column_oriented` a block is a list of columns, as read from the
+    source stream, and is inserted without ever being turned into rows.
+    """
+
+    def __init__(self, name: str, client, table: str, column_names, max_lag: int, log,
+                 token_prefix: str = "", profiler: Optional[StageProfiler] = None,
+                 query_id_prefix: str = "", job: Optional["Job"] = None,
+                 spill: Optional[SpillQueue] = None, column_oriented: bool = False):
+        self.name = name
+        self.client = client
+        self.table = table
+        self.column_names = column_names
+        self.column_oriented = column_oriented
+        self.token_prefix = token_prefix
+        self.profiler = profiler or StageProfiler(enabled=False)
+        self.query_id_prefix = query_id_prefix
+        self.job = job
+        self.spill = spill
+        self.rows = 0
+        self.blocks = 0
+        self.error: Optional[Exception] = None
+        self._log = log
+        self._last_report = time.monotonic()
+        self._queue: queue.Queue = queue.Queue(maxsize=max(1, max_lag))
+        self._thread = threading.Thread(target=self._run_spill if spill else self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, rows: list):
+        if self.error is None:
+            with self.profiler.stage("queue.backpressure"):
+                if self.spill is not None:
+                    self.spill.put(rows)
+                else:
+                    self._queue.put(rows)
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+        else:
+            self._queue.put(None)
+        self._thread.join()
+        if self.spill is not None:
+            self.spill.remove()
+
+    def _skipping(self) -> bool:
+        return self.error is not None or (self.job is not None and self.job.cancelled)
+
+    def _insert(self, index: int, rows: list):
+        settings = {
+            "insert_deduplicate": 1,
+            "insert_deduplication_token": dedup_token(self.token_prefix, index),
+        }
+
+        def _attempt():
+            if self.query_id_prefix:
+                settings["query_id"] = stage_query_id(self.query_id_prefix, "ins", index)
+            with self.profiler.stage("dest.insert"):
+                self.client.insert(table=self.table, data=rows, column_names=self.column_names,
+                                   settings=settings, column_oriented=self.column_oriented)
+
+        call_with_retry(_attempt, f"  [{self.name}] {self.table} блок {index}", self._log, job=self.job)
+        self.rows += len(rows[0]) if self.column_oriented else len(rows)
+        if time.monotonic() - self._last_report >= PROGRESS_LOG_INTERVAL:
+            self._last_report = time.monotonic()
+            self._log(f"  [{self.name}] {self.table}: {self.rows} строк...")
+
+    def _run(self):
+        while True:
+            rows = self._queue.get()
+            if rows is None:
+                return
+            index = self.blocks
+            self.blocks += 1
+            if self._skipping():
+                continue
+            try:
+                self._insert(index, rows)
+            except JobCancelled:
+                continue
+            except Exception as e:
+                self.error = e
+                self._log(f"  [{self.name}] ОШИБКА вставки в {self.table}: {e}", "ERROR")
+
+    def _run_spill(self):
+        restarts = 0
+        while True:
+            item = self.spill.get()
+            if item is None:
+                return
+            index, rows = item
+            self.blocks = max(self.blocks, index + 1)
+            if self._skipping():
+                self.spill.ack()
+                continue
+            try:
+                self._insert(index, rows)
+                self.spill.ack()
+            except JobCancelled:
+                self.spill.ack()
+            except Exception as e:
+                if restarts >= SPILL_WRITER_RESTARTS:
+                    self.error = e
+                    self._log(f"  [{self.name}] ОШИБКА вставки в {self.table}: {e}", "ERROR")
+                    self.spill.abort()
+                    return
+                restarts += 1
+                self._log(f"  [{self.name}] {self.table}: перезапуск записи из spill "
+                          f"({restarts}/{SPILL_WRITER_RESTARTS}) после ошибки: {e}", "WARN")
+                # A cancelled job wakes the writer, which then drains the spill without inserting
+                if self.job is not None:
+                    self.job.wait(RETRY_MAX_DELAY)
+                else:
+                    time.sleep(RETRY_MAX_DELAY)
+                self.spill.rewind()
+
+
+class ShardRouter:
+    """Splits blocks by destination shard and feeds one DestinationWriter per shard.
+
+    Rows arrive with the sharding key, already cast to unsigned by the source,
+    as their last value. A row goes to shard `slots[key % len(slots)]`, where
+    `slots` repeats every shard index by its weight, as in the Distributed engine.
+    With `column_oriented` blocks are lists of columns, the key column last,
+    and every shard gets its positions picked out of each column.
+    """
+
+    def __init__(self, name: str, writers: list[DestinationWriter], slots: list[int],
+                 column_oriented: bool = False):
+        self.name = name
+        self.writers = writers
+        self.slots = slots
+        self.column_oriented = column_oriented
+
+    @property
+    def rows(self) -> int:
+        return sum(writer.rows for writer in self.writers)
+
+    @property
+    def blocks(self) -> int:
+        return sum(writer.blocks for writer in self.writers)
+
+    @property
+    def error(self) -> Optional[Exception]:
+        return next((writer.error for writer in self.writers if writer.error is not None), None)
+
+    def put(self, rows: list):
+        buckets: list[list] = [[] for _ in self.writers]
+        total = len(self.slots)
+        if self.column_oriented:
+            for i, key in enumerate(rows[-1]):
+                buckets[self.slots[key % total]].append(i)
+            for writer, positions in zip(self.writers, buckets):
+                if len(positions) == len(rows[-1]):
+                    writer.put(rows[:-1])
+                elif len(positions) > 1:
+                    pick = operator.itemgetter(*positions)
+                    writer.put([pick(column) for column in rows[:-1]])
+                elif positions:
+                    writer.put([[column[positions[0]]] for column in rows[:-1]])
+            return
+        for row in rows:
+            buckets[self.slots[row[-1] % total]].append(row[:-1])
+        for writer, bucket in zip(self.writers, buckets):
+            if bucket:
+                writer.put(bucket)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+def stream_error(tail: bytes, exception_tag: Optional[str] = None) -> Optional[str]:
+    """Error text the server appended to the end of a response body, if any.
+
+    A query that fails after the 200 status has been sent ends its body with
+    the exception: between `__exception__` markers carrying the tag from
+    EXCEPTION_TAG_HEADER (v25.11+), or as a plain `Code: N. DB::Exception` line.
+    """
+    if exception_tag:
+        pos = tail.find(b"__exception__")
+        if pos < 0:
+            return None
+        text = tail[pos:].decode("utf-8", "replace")
+        return text.replace("__exception__", "").replace(exception_tag, "").strip()
+    m = re.search(rb"Code: \d+\. DB::Exception\b.*", tail, re.S)
+    return m.group(0).decode("utf-8", "replace").strip() if m else None
+
+
+class PassthroughWriter:
+    """Streams raw source bytes into one destination as a single INSERT ... FORMAT.
+
+    Chunks arrive through a bounded queue, like the blocks of DestinationWriter,
+    and become the request body of raw_insert as they come, so they are never
+    decoded, re-encoded or copied per destination. The server splits the stream
+    into blocks and suffixes `token` with the block number. close(abort=error)
+    makes the request body fail, so a truncated stream is not committed as
+    complete; blocks the server has written by then stay.
+    """
+
+    def __init__(self, name: str, client, table: str, max_lag: int, log, token: str = "",
+                 profiler: Optional[StageProfiler] = None, query_id_prefix: str = "",
+                 job: Optional["Job"] = None):
+        self.name = name
+        self.client = client
+        self.table = table
+        self.token = token
+        self.profiler = profiler or StageProfiler(enabled=False)
+        self.query_id_prefix = query_id_prefix
+        self.job = job
+        self.rows = 0
+        self.bytes = 0
+        self.error: Optional[Exception] = None
+        self._log = log
+        self._ended = False
+        self._aborted = False
+        self._last_report = time.monotonic()
+        self._queue: queue.Queue = queue.Queue(maxsize=max(1, max_lag))
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, chunk: bytes):
+        if self.error is None:
+            with self.profiler.stage("queue.backpressure"):
+                self._queue.put(chunk)
+
+    def close(self, abort: Optional[Exception] = None):
+        self._aborted = abort is not None
+        self._queue.put(abort)
+        self._thread.join()
+
+    def _chunks(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None or isinstance(chunk, Exception):
+                self._ended = True
+                if chunk is not None:
+                    raise chunk
+                return
+            if self.job is not None:
+                self.job.check()
+            self.bytes += len(chunk)
+            if time.monotonic() - self._last_report >= PROGRESS_LOG_INTERVAL:
+                self._last_report = time.monotonic()
+                self._log(f"  [{self.name}] {self.table}: {self.bytes / 1024 / 1024:.0f} МБ...")
+            yield chunk
+
+    def _run(self):
+        settings = {"insert_deduplicate": 1, "insert_deduplication_token": self.token}
+        if self.query_id_prefix:
+            settings["query_id"] = stage_query_id(self.query_id_prefix, "ins", "raw")
+        try:
+            with self.profiler.stage("dest.raw_insert"):
+                summary = self.client.raw_insert(self.table, insert_block=self._chunks(),
+                                                 settings=settings, fmt=PASSTHROUGH_FORMAT)
+            # A request replayed by the HTTP layer would send the rest of a consumed generator
+            if not self._ended:
+                raise RuntimeError("поток вставки прерван до конца данных")
+            self.rows = summary.written_rows
+        except Exception as e:
+            # JobCancelled from the body generator may come back wrapped by the HTTP layer
+            if self.job is None or not self.job.cancelled:
+                self.error = e
+                # An aborted insert is reported by the reader
+                if not self._aborted:
+                    self._log(f"  [{self.name}] ОШИБКА вставки в {self.table}: {e}", "ERROR")
+        # A failed insert keeps draining, so the reader and the other destinations carry on
+        while not self._ended:
+            item = self._queue.get()
+            self._ended = item is None or isinstance(item, Exception)
+
+
+class Job:
+    """A queued unit of background work with cooperative cancellation.
+
+    The job function receives the Job and calls check() at safe points.
+    Hooks registered with on_cancel() run in a separate thread when the job
+    is cancelled, e.g. to KILL its queries on the servers.
+    """
+
+    def __init__(self, name: str, fn, timeout: float = 0.0):
+        self.name = name
+        self.fn = fn
+        self.timeout = timeout
+        self.state = "queued"
+        self.reason = ""
+        self.error: Optional[Exception] = None
+        self._cancel = threading.Event()
+        self._hooks: list = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def check(self):
+        if self._cancel.is_set():
+            raise JobCancelled(self.reason)
+
+    def wait(self, seconds: float) -> bool:
+        """Sleep up to `seconds`, waking early on cancellation; True if cancelled."""
+        return self._cancel.wait(seconds)
+
+    def on_cancel(self, hook):
+        with self._lock:
+            if not self._cancel.is_set():
+                self._hooks.append(hook)
+                return
+        threading.Thread(target=hook, daemon=True).start()
+
+    def cancel(self, reason: str = "cancelled"):
+        with self._lock:
+            if self._cancel.is_set() or self.state not in ("queued", "running"):
+                return
+            self.reason = reason
+            self._cancel.set()
+            hooks, self._hooks = self._hooks, []
+        for hook in hooks:
+            threading.Thread(target=hook, daemon=True).start()
+
+
+class JobExecutor:
+    """Runs jobs one at a time, in submission order, on a single worker thread.
+
+    A job with a timeout is cancelled with reason "timeout" when it runs
+    longer than that; `on_change(job, state)` is called from the worker
+    thread on every state change.
+    """
+
+    def __init__(self, on_change=None):
+        self._on_change = on_change or (lambda job, state: None)
+        self._queue: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self.jobs: list[Job] = []
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, name: str, fn, timeout: float = 0.0) -> Job:
+        job = Job(name, fn, timeout)
+        with self._lock:
+            self.jobs.append(job)
+        self._on_change(job, job.state)
+        self._queue.put(job)
+        return job
+
+    def active(self) -> list[Job]:
+        with self._lock:
+            self.jobs = [job for job in self.jobs if job.state in ("queued", "running")]
+            return list(self.jobs)
+
+    def cancel_all(self):
+        for job in self.active():
+            job.cancel()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job.cancelled:
+                self._finish(job, "cancelled")
+                continue
+            job.state = "running"
+            self._on_change(job, job.state)
+            timer = None
+            if job.timeout > 0:
+                timer = threading.Timer(job.timeout, job.cancel, args=("timeout",))
+                timer.daemon = True
+                timer.start()
+            try:
+                job.fn(job)
+                state = "done"
+            except JobCancelled:
+                state = job.reason
+            except Exception as e:
+                job.error = e
+                state = "failed"
+            finally:
+                if timer is not None:
+                    timer.cancel()
+            if job.cancelled and state == "done":
+                state = job.reason
+            self._finish(job, state)
+
+    def _finish(self, job: Job, state: str):
+        job.state = state
+        self._on_change(job, state)
 
 
 class CHMigrateApp:
@@ -39,8 +1180,20 @@ class CHMigrateApp:
         self.selected_tables: set[tuple[str, str]] = set()
         self.table_ddls: dict[tuple[str, str], str] = {}
         self.table_columns: dict[tuple[str, str], list[dict]] = {}
+        # INDEX / PROJECTION clauses stripped from generated DDL, added after the data load
+        self.deferred_clauses: dict[tuple[str, str], list[str]] = {}
+        # Tables the generated DDL keeps on destination (schema diff), skipped by the data copy
+        self.kept_tables: set[tuple[str, str]] = set()
         # map treeview item id -> (database, table)
         self.tree_item_map: dict[str, tuple[str, str]] = {}
+        # live read throttles: "" -> global, source name -> per-connection
+        self.throttles: dict[str, Throttle] = {}
+        # set while a profiled migration runs, times Tk log callbacks
+        self._ui_profiler: Optional[StageProfiler] = None
+        self._throttles_lock = threading.Lock()
+        # single worker thread for DDL generation / creation and data migration
+        self.jobs = JobExecutor(
+            lambda job, state: self.root.after(0, lambda: self._on_job_change(job, state)))
 
         self._build_gui()
 
@@ -85,9 +1238,16 @@ class CHMigrateApp:
         ttk.Button(src_frame, text="\u2716", width=2,
                    command=self._delete_source).pack(side=tk.LEFT, padx=(3, 0))
 
+        ttk.Button(src_frame, text="Мульти...",
+                   command=self._show_multisource_dialog).pack(side=tk.LEFT, padx=(3, 0))
+
         self.lbl_src_status = ttk.Label(src_frame, text="Не подключён", foreground="red")
         self.lbl_src_status.pack(side=tk.LEFT, padx=10)
 
+        self.lbl_multisource = ttk.Label(src_frame, text="")
+        self.lbl_multisource.pack(side=tk.LEFT)
+        self._refresh_multisource_label()
+
         # Destination
         dst_frame = ttk.LabelFrame(bar, text="Destination", padding=5)
         dst_frame.pack(side=tk.LEFT, fill=tk.X, expand=True)
@@ -104,9 +1264,17 @@ class CHMigrateApp:
                                           command=self._stop_docker_ch, state=tk.DISABLED)
         self.btn_docker_stop.pack(side=tk.LEFT, padx=(5, 0))
 
+        self.btn_fanout = ttk.Button(dst_frame, text="Fan-out...",
+                                     command=self._show_fanout_dialog)
+        self.btn_fanout.pack(side=tk.LEFT, padx=(5, 0))
+
         self.lbl_dst_status = ttk.Label(dst_frame, text="Не подключён", foreground="red")
         self.lbl_dst_status.pack(side=tk.LEFT, padx=10)
 
+        self.lbl_fanout = ttk.Label(dst_frame, text="")
+        self.lbl_fanout.pack(side=tk.LEFT)
+        self._refresh_fanout_label()
+
     def _build_left_panel(self, parent):
         # Schema tree
         tree_frame = ttk.LabelFrame(parent, text="Схема Source", padding=5)
@@ -203,6 +1371,8 @@ class CHMigrateApp:
                    ).pack(side=tk.LEFT)
         ttk.Button(sql_btn_frame, text="Сгенерировать SELECT",
                    command=self._generate_select_sql).pack(side=tk.LEFT, padx=5)
+        ttk.Button(sql_btn_frame, text="Трансформации...",
+                   command=self._show_transforms_dialog).pack(side=tk.LEFT)
 
         # Migration DDL
         ddl_mig_frame = ttk.LabelFrame(parent, text="DDL для миграции (редактируемый)", padding=5)
@@ -226,16 +1396,28 @@ class CHMigrateApp:
         action_frame.pack(fill=tk.X, pady=(5, 0))
 
         self.btn_gen_ddl = ttk.Button(action_frame, text="Генерировать DDL",
-                                      command=self._generate_ddl)
+                                      command=lambda: self._submit_job("Генерация DDL", self._generate_ddl))
         self.btn_gen_ddl.pack(side=tk.LEFT, padx=(0, 5))
 
         self.btn_create_ddl = ttk.Button(action_frame, text="Создать DDL на Destination",
-                                         command=self._create_ddl_on_destination)
+                                         command=lambda: self._submit_job("Создание DDL",
+                                                                          self._create_ddl_on_destination))
         self.btn_create_ddl.pack(side=tk.LEFT, padx=(0, 5))
 
         self.btn_migrate = ttk.Button(action_frame, text="Мигрировать данные",
-                                      command=self._migrate_data)
-        self.btn_migrate.pack(side=tk.LEFT)
+                                      command=lambda: self._submit_job("Миграция данных", self._migrate_data))
+        self.btn_migrate.pack(side=tk.LEFT, padx=(0, 5))
+
+        self.btn_cancel = ttk.Button(action_frame, text="Отмена", command=self._cancel_jobs,
+                                     state=tk.DISABLED)
+        self.btn_cancel.pack(side=tk.LEFT, padx=(0, 5))
+        self.lbl_jobs = ttk.Label(action_frame, text="", foreground="gray")
+        self.lbl_jobs.pack(side=tk.LEFT)
+
+        ttk.Button(action_frame, text="Параметры...",
+                   command=self._show_options_dialog).pack(side=tk.RIGHT)
+        ttk.Button(action_frame, text="Троттлинг...",
+                   command=self._show_throttle_dialog).pack(side=tk.RIGHT, padx=(0, 5))
 
         # Log
         log_frame = ttk.LabelFrame(parent, text="Лог", padding=5)
@@ -280,11 +1462,13 @@ class CHMigrateApp:
     def _add_source_dialog(self):
         self._show_source_edit_dialog()
 
-    def _show_source_edit_dialog(self, edit_name: str = ""):
-        params = self.connections.get("sources", {}).get(edit_name, {}) if edit_name else {}
+    def _show_source_edit_dialog(self, edit_name: str = "", kind: str = "sources", on_saved=None):
+        """Edit a named server stored in connections.json under `kind` ("sources" / "destinations")."""
+        params = self.connections.get(kind, {}).get(edit_name, {}) if edit_name else {}
+        new_title = "Новый сервер-источник" if kind == "sources" else "Новый сервер-приёмник"
 
         dlg = tk.Toplevel(self.root)
-        dlg.title("Новый сервер-источник" if not edit_name else f"Редактировать: {edit_name}")
+        dlg.title(new_title if not edit_name else f"Редактировать: {edit_name}")
         dlg.geometry("450x360")
         dlg.resizable(False, False)
         dlg.transient(self.root)
@@ -327,10 +1511,11 @@ class CHMigrateApp:
         ssl_var = tk.BooleanVar(value=params.get("secure", False))
 
         def _on_ssl_toggle():
-            if ssl_var.get() and port_var.get() == "8123":
-                port_var.set("8443")
-            elif not ssl_var.get() and port_var.get() == "8443":
-                port_var.set("8123")
+            ports = {"8123": "8443", "9000": "9440"}
+            if not ssl_var.get():
+                ports = {secure: plain for plain, secure in ports.items()}
+            if port_var.get() in ports:
+                port_var.set(ports[port_var.get()])
 
         ttk.Checkbutton(frame, text="SSL/TLS", variable=ssl_var, command=_on_ssl_toggle).grid(row=6, column=0, sticky="w", pady=3)
 
@@ -370,16 +1555,19 @@ class CHMigrateApp:
                 "secure": ssl_var.get(),
                 "ca_cert": cert_var.get().strip(),
             }
-            if "sources" not in self.connections:
-                self.connections["sources"] = {}
+            if kind not in self.connections:
+                self.connections[kind] = {}
             # If renaming, remove old key
-            if edit_name and edit_name != srv_name and edit_name in self.connections["sources"]:
-                del self.connections["sources"][edit_name]
-            self.connections["sources"][srv_name] = new_params
+            if edit_name and edit_name != srv_name and edit_name in self.connections[kind]:
+                del self.connections[kind][edit_name]
+            self.connections[kind][srv_name] = new_params
             self._save_connections()
-            self._refresh_source_combo()
-            self.source_combo.set(srv_name)
-            self._on_source_selected()
+            if kind == "sources":
+                self._refresh_source_combo()
+                self.source_combo.set(srv_name)
+                self._on_source_selected()
+            if on_saved:
+                on_saved(srv_name)
             dlg.destroy()
             self._log(f"Сервер '{srv_name}' сохранён")
 
@@ -461,25 +1649,7 @@ class CHMigrateApp:
 
     @staticmethod
     def _make_client_from_params(params: dict):
-        port = int(params.get("port", 8123))
-        secure = params.get("secure", False)
-        ca_cert = params.get("ca_cert", "")
-
-        kwargs = dict(
-            host=params.get("host", "localhost"),
-            port=port,
-            username=params.get("user", "default"),
-            password=params.get("password", ""),
-            database=params.get("database", "default"),
-        )
-        if secure:
-            kwargs["secure"] = True
-        if ca_cert and os.path.isfile(ca_cert):
-            kwargs["ca_cert"] = ca_cert
-        elif secure:
-            kwargs["verify"] = False
-
-        return clickhouse_connect.get_client(**kwargs)
+        return make_client(params)
 
     def _show_connection_dialog(self, prefix: str):
         params = self.source_params if prefix == "SOURCE" else self.dest_params
@@ -588,39 +1758,51 @@ class CHMigrateApp:
             self._log("Выберите сервер-источник из списка или создайте новый (+)", "WARN")
             return
 
-        def _do():
+        params = dict(self.source_params)
+
+        def _do(job: Job):
             try:
-                self.source_client = self._make_client_from_params(self.source_params)
+                client = self._make_client_from_params(params)
+                job.check()
+                self.source_client = client
                 ver = self.source_client.server_version
-                host = self.source_params["host"]
-                port = self.source_params["port"]
+                host = params["host"]
+                port = params["port"]
                 self.root.after(0, lambda: self.lbl_src_status.config(
                     text=f"Подключён ({ver})", foreground="green"))
                 self._log(f"Source подключён: {host}:{port}")
                 self.root.after(0, self._load_schema_tree)
+            except JobCancelled:
+                raise
             except Exception as e:
                 self.root.after(0, lambda: self.lbl_src_status.config(
                     text="Ошибка", foreground="red"))
                 self._log(f"Ошибка подключения Source: {e}", "ERROR")
 
-        threading.Thread(target=_do, daemon=True).start()
+        self._submit_job("Подключение Source", lambda: _do)
 
     def _connect_destination(self):
-        def _do():
+        params = dict(self.dest_params)
+
+        def _do(job: Job):
             try:
-                self.dest_client = self._make_client_from_params(self.dest_params)
+                client = self._make_client_from_params(params)
+                job.check()
+                self.dest_client = client
                 ver = self.dest_client.server_version
-                host = self.dest_params["host"]
-                port = self.dest_params["port"]
+                host = params["host"]
+                port = params["port"]
                 self.root.after(0, lambda: self.lbl_dst_status.config(
                     text=f"Подключён ({ver})", foreground="green"))
                 self._log(f"Destination подключён: {host}:{port}")
+            except JobCancelled:
+                raise
             except Exception as e:
                 self.root.after(0, lambda: self.lbl_dst_status.config(
                     text="Ошибка", foreground="red"))
                 self._log(f"Ошибка подключения Destination: {e}", "ERROR")
 
-        threading.Thread(target=_do, daemon=True).start()
+        self._submit_job("Подключение Destination", lambda: _do)
 
     # ── Docker ClickHouse ────────────────────────────────────────────
 
@@ -667,7 +1849,7 @@ class CHMigrateApp:
         ttk.Button(btn_frame, text="Отмена", command=dlg.destroy).pack(side=tk.LEFT, padx=5)
 
     def _start_docker_ch(self, name: str, port: str, image: str, password: str):
-        def _do():
+        def _do(job: Job):
             try:
                 # Check docker is available
                 r = subprocess.run(["docker", "info"], capture_output=True, timeout=10)
@@ -680,6 +1862,7 @@ class CHMigrateApp:
                 # Remove old container with same name if exists
                 subprocess.run(["docker", "rm", "-f", name],
                                capture_output=True, timeout=15)
+                job.check()
 
                 # Build docker run command
                 cmd = [
@@ -703,7 +1886,8 @@ class CHMigrateApp:
                 int_port = int(port)
                 client = None
                 for attempt in range(30):
-                    time.sleep(1)
+                    job.check()
+                    job.wait(1)
                     try:
                         kwargs = dict(host="localhost", port=int_port,
                                       username="default", password=password)
@@ -718,17 +1902,26 @@ class CHMigrateApp:
                     self._log("ClickHouse в контейнере не отвечает после 30 сек", "ERROR")
                     return
 
+                job.check()
                 self.dest_client = client
+                # Keep params so worker threads can open their own connections
+                self.dest_params = {
+                    "host": "localhost", "port": port, "user": "default",
+                    "password": password, "database": "default",
+                    "secure": False, "ca_cert": "",
+                }
                 ver = self.dest_client.server_version
                 self.root.after(0, lambda: self.lbl_dst_status.config(
                     text=f"Docker ({ver})", foreground="green"))
                 self.root.after(0, lambda: self.btn_docker_stop.config(state=tk.NORMAL))
                 self._log(f"Destination подключён: Docker контейнер {name} (localhost:{port})")
 
+            except JobCancelled:
+                raise
             except Exception as e:
                 self._log(f"Ошибка Docker: {e}", "ERROR")
 
-        threading.Thread(target=_do, daemon=True).start()
+        self._submit_job("Запуск Docker", lambda: _do)
 
     def _stop_docker_ch(self):
         if not self.docker_container_name:
@@ -736,7 +1929,7 @@ class CHMigrateApp:
 
         name = self.docker_container_name
 
-        def _do():
+        def _do(job: Job):
             try:
                 subprocess.run(["docker", "stop", name], capture_output=True, timeout=30)
                 subprocess.run(["docker", "rm", name], capture_output=True, timeout=15)
@@ -749,7 +1942,362 @@ class CHMigrateApp:
             except Exception as e:
                 self._log(f"Ошибка остановки Docker: {e}", "ERROR")
 
-        threading.Thread(target=_do, daemon=True).start()
+        self._submit_job("Остановка Docker", lambda: _do)
+
+    # ── Migration Options ────────────────────────────────────────────
+
+    def _migration_options(self) -> dict:
+        saved = self.connections.get("options", {})
+        return {key: type(default)(saved.get(key, default))
+                for key, (_, default) in MIGRATION_OPTIONS.items()}
+
+    def _show_options_dialog(self):
+        """Edit MIGRATION_OPTIONS; values are stored in connections.json."""
+        dlg = tk.Toplevel(self.root)
+        dlg.title("Параметры миграции")
+        dlg.transient(self.root)
+
+        frame = ttk.Frame(dlg, padding=15)
+        frame.pack(fill=tk.BOTH, expand=True)
+
+        current = self._migration_options()
+        variables = {}
+        for row, (key, (label, default)) in enumerate(MIGRATION_OPTIONS.items()):
+            if isinstance(default, bool):
+                var = tk.BooleanVar(value=current[key])
+                ttk.Checkbutton(frame, text=label, variable=var).grid(
+                    row=row, column=0, columnspan=2, sticky="w", pady=2)
+            else:
+                var = tk.StringVar(value=str(current[key]))
+                ttk.Label(frame, text=label + ":").grid(row=row, column=0, sticky="w", pady=2)
+                ttk.Entry(frame, textvariable=var, width=14).grid(row=row, column=1, sticky="w", padx=5)
+            variables[key] = var
+
+        def on_save():
+            values = {}
+            for key, var in variables.items():
+                default = MIGRATION_OPTIONS[key][1]
+                try:
+                    values[key] = type(default)(var.get())
+                except ValueError:
+                    messagebox.showwarning("Ошибка", f"Некорректное значение: {MIGRATION_OPTIONS[key][0]}",
+                                           parent=dlg)
+                    return
+            self.connections["options"] = values
+            self._save_connections()
+            dlg.destroy()
+            self._log("Параметры миграции сохранены")
+
+        btn_frame = ttk.Frame(frame)
+        btn_frame.grid(row=len(MIGRATION_OPTIONS), column=0, columnspan=2, pady=(12, 0))
+        ttk.Button(btn_frame, text="Сохранить", command=on_save).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="Отмена", command=dlg.destroy).pack(side=tk.LEFT, padx=5)
+
+    # ── Source Throttling ────────────────────────────────────────────
+
+    def _throttle_config(self, name: str) -> dict:
+        """Saved limits and read settings for a source ("" = global profile)."""
+        cfg = self.connections.get("throttle", {})
+        return cfg.get("global", {}) if not name else cfg.get("sources", {}).get(name, {})
+
+    def _get_throttle(self, name: str) -> Throttle:
+        with self._throttles_lock:
+            if name not in self.throttles:
+                throttle = Throttle()
+                cfg = self._throttle_config(name)
+                throttle.configure(cfg.get("rows", 0), cfg.get("mb", 0), cfg.get("queries", 0))
+                self.throttles[name] = throttle
+            return self.throttles[name]
+
+    def _read_settings(self, name: str) -> dict:
+        """Server settings attached to every read from the source `name`."""
+        settings = dict(self._throttle_config("").get("settings", {}))
+        settings.update(self._throttle_config(name).get("settings", {}))
+        return settings
+
+    @staticmethod
+    def _estimate_row_bytes(client, db: str, table: str) -> float:
+        """Average uncompressed row size, used to meter MB/s without touching values.
+
+        0 when system.tables has no row count: Distributed tables, views and
+        empty tables. The MB/s limit then cannot be applied to the copy.
+        """
+        rows = client.query(
+            "SELECT sum(data_uncompressed_bytes), any(t.total_rows) FROM system.columns AS c "
+            "INNER JOIN system.tables AS t ON c.database = t.database AND c.table = t.name "
+            "WHERE c.database = %(db)s AND c.table = %(tbl)s",
+            parameters={"db": db, "tbl": table},
+        ).result_rows
+        if not rows or not rows[0][1]:
+            return 0.0
+        return rows[0][0] / rows[0][1]
+
+    def _show_throttle_dialog(self):
+        """Read limits per source and globally; "Применить" updates a running migration."""
+        dlg = tk.Toplevel(self.root)
+        dlg.title("Троттлинг чтения из source")
+        dlg.transient(self.root)
+
+        frame = ttk.Frame(dlg, padding=15)
+        frame.pack(fill=tk.BOTH, expand=True)
+
+        columns = [key for key, _ in THROTTLE_LIMITS] + list(SOURCE_READ_SETTINGS)
+        headers = [label for _, label in THROTTLE_LIMITS] + list(SOURCE_READ_SETTINGS)
+        for col, header in enumerate(headers, 1):
+            ttk.Label(frame, text=header).grid(row=0, column=col, padx=3)
+
+        names = [""] + sorted(self.connections.get("sources", {}))
+        variables: dict[str, dict[str, tk.StringVar]] = {}
+        for row, name in enumerate(names, 1):
+            cfg = self._throttle_config(name)
+            ttk.Label(frame, text=name or "Глобально").grid(row=row, column=0, sticky="w", pady=2)
+            variables[name] = {}
+            for col, key in enumerate(columns, 1):
+                value = cfg.get("settings", {}).get(key, "") if key in SOURCE_READ_SETTINGS \
+                    else cfg.get(key, "") or ""
+                var = tk.StringVar(value=str(value))
+                ttk.Entry(frame, textvariable=var, width=10).grid(row=row, column=col, padx=3)
+                variables[name][key] = var
+
+        ttk.Label(frame, foreground="gray", text=(
+            "0 или пусто — без ограничения. Глобальные лимиты действуют на все источники вместе, "
+            "настройки сервера — по умолчанию для каждого источника."
+        ), wraplength=700).grid(row=len(names) + 1, column=0, columnspan=len(columns) + 1,
+                                sticky="w", pady=(8, 0))
+
+        def on_apply():
+            cfg = {"global": {}, "sources": {}}
+            try:
+                for name, row_vars in variables.items():
+                    entry = {"settings": {}}
+                    for key, var in row_vars.items():
+                        value = var.get().strip()
+                        if not value:
+                            continue
+                        if key in SOURCE_READ_SETTINGS:
+                            entry["settings"][key] = int(value)
+                        else:
+                            entry[key] = float(value) if key != "queries" else int(value)
+                    if name:
+                        cfg["sources"][name] = entry
+                    else:
+                        cfg["global"] = entry
+            except ValueError:
+                messagebox.showwarning("Ошибка", "Значения должны быть числами", parent=dlg)
+                return
+            self.connections["throttle"] = cfg
+            self._save_connections()
+            # Workers add throttles for new sources while a migration runs
+            with self._throttles_lock:
+                throttles = list(self.throttles.items())
+            for name, throttle in throttles:
+                limits = self._throttle_config(name)
+                throttle.configure(limits.get("rows", 0), limits.get("mb", 0), limits.get("queries", 0))
+            self._log("Троттлинг обновлён")
+
+        btn_frame = ttk.Frame(frame)
+        btn_frame.grid(row=len(names) + 2, column=0, columnspan=len(columns) + 1, pady=(12, 0))
+        ttk.Button(btn_frame, text="Применить", command=on_apply).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="Закрыть", command=dlg.destroy).pack(side=tk.LEFT, padx=5)
+
+    # ── Fan-out Destinations ─────────────────────────────────────────
+
+    def _fanout_config(self) -> dict:
+        cfg = self.connections.get("fanout", {})
+        known = self.connections.get("destinations", {})
+        return {
+            "targets": [n for n in cfg.get("targets", []) if n in known],
+            "max_lag": int(cfg.get("max_lag", DEFAULT_FANOUT_MAX_LAG)),
+        }
+
+    def _refresh_fanout_label(self):
+        targets = self._fanout_config()["targets"]
+        self.lbl_fanout.config(text=f"+{len(targets)} fan-out" if targets else "")
+
+    def _show_fanout_dialog(self):
+        """Pick extra destinations that receive the same source blocks."""
+        dlg = tk.Toplevel(self.root)
+        dlg.title("Fan-out: дополнительные destinations")
+        dlg.geometry("420x340")
+        dlg.transient(self.root)
+        dlg.grab_set()
+
+        frame = ttk.Frame(dlg, padding=15)
+        frame.pack(fill=tk.BOTH, expand=True)
+
+        ttk.Label(frame, text="Сохранённые серверы (выделите нужные):").pack(anchor="w")
+        listbox = tk.Listbox(frame, selectmode=tk.MULTIPLE, height=8, exportselection=False)
+        listbox.pack(fill=tk.BOTH, expand=True, pady=(3, 5))
+
+        def _fill(select: Optional[list[str]] = None):
+            chosen = select if select is not None else [
+                listbox.get(i) for i in listbox.curselection()]
+            listbox.delete(0, tk.END)
+            for i, name in enumerate(sorted(self.connections.get("destinations", {}))):
+                listbox.insert(tk.END, name)
+                if name in chosen:
+                    listbox.selection_set(i)
+
+        cfg = self._fanout_config()
+        _fill(cfg["targets"])
+
+        def _on_saved(name: str):
+            _fill([listbox.get(i) for i in listbox.curselection()] + [name])
+
+        def _delete():
+            for i in listbox.curselection():
+                self.connections.get("destinations", {}).pop(listbox.get(i), None)
+            self._save_connections()
+            _fill([])
+
+        list_btns = ttk.Frame(frame)
+        list_btns.pack(fill=tk.X)
+        ttk.Button(list_btns, text="+", width=2,
+                   command=lambda: self._show_source_edit_dialog(kind="destinations", on_saved=_on_saved)
+                   ).pack(side=tk.LEFT)
+        ttk.Button(list_btns, text="\u2716", width=2, command=_delete).pack(side=tk.LEFT, padx=(3, 0))
+
+        lag_frame = ttk.Frame(frame)
+        lag_frame.pack(fill=tk.X, pady=(8, 0))
+        ttk.Label(lag_frame, text="Макс. отставание (блоков):").pack(side=tk.LEFT)
+        lag_var = tk.StringVar(value=str(cfg["max_lag"]))
+        ttk.Entry(lag_frame, textvariable=lag_var, width=6).pack(side=tk.LEFT, padx=5)
+
+        def on_apply():
+            lag = lag_var.get().strip()
+            self.connections["fanout"] = {
+                "targets": [listbox.get(i) for i in listbox.curselection()],
+                "max_lag": int(lag) if lag.isdigit() and int(lag) > 0 else DEFAULT_FANOUT_MAX_LAG,
+            }
+            self._save_connections()
+            self._refresh_fanout_label()
+            dlg.destroy()
+            targets = self.connections["fanout"]["targets"]
+            self._log(f"Fan-out: {', '.join(targets) if targets else 'выключен'}")
+
+        btn_frame = ttk.Frame(frame)
+        btn_frame.pack(pady=(12, 0))
+        ttk.Button(btn_frame, text="Применить", command=on_apply).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="Отмена", command=dlg.destroy).pack(side=tk.LEFT, padx=5)
+
+    def _connect_fanout_targets(self, include_primary: bool = False) -> list[tuple[str, object]]:
+        """Open a connection per extra destination; unreachable ones are skipped.
+
+        With include_primary the main destination gets a fresh connection too,
+        for workers that must not share `self.dest_client` with another thread.
+        """
+        targets = []
+        if include_primary:
+            targets.append(("Destination", self._make_client_from_params(self.dest_params)))
+        known = self.connections.get("destinations", {})
+        for name in self._fanout_config()["targets"]:
+            try:
+                targets.append((name, self._make_client_from_params(known[name])))
+            except Exception as e:
+                self._log(f"Fan-out '{name}' недоступен, пропущен: {e}", "ERROR")
+        return targets
+
+    # ── Multi-source Consolidation ───────────────────────────────────
+
+    def _multisource_config(self) -> dict:
+        cfg = self.connections.get("multisource", {})
+        known = self.connections.get("sources", {})
+        return {
+            "sources": [n for n in cfg.get("sources", []) if n in known],
+            "tag_column": cfg.get("tag_column", ""),
+        }
+
+    def _refresh_multisource_label(self):
+        cfg = self._multisource_config()
+        parts = []
+        if cfg["sources"]:
+            parts.append(f"+{len(cfg['sources'])} источн.")
+        if cfg["tag_column"]:
+            parts.append(f"тег `{cfg['tag_column']}`")
+        self.lbl_multisource.config(text=", ".join(parts))
+
+    def _show_multisource_dialog(self):
+        """Pick extra sources whose tables are consolidated into the destination."""
+        dlg = tk.Toplevel(self.root)
+        dlg.title("Консолидация нескольких источников")
+        dlg.geometry("420x320")
+        dlg.transient(self.root)
+        dlg.grab_set()
+
+        frame = ttk.Frame(dlg, padding=15)
+        frame.pack(fill=tk.BOTH, expand=True)
+
+        cfg = self._multisource_config()
+        ttk.Label(frame, text="Дополнительные источники (помимо текущего):").pack(anchor="w")
+        listbox = tk.Listbox(frame, selectmode=tk.MULTIPLE, height=8, exportselection=False)
+        listbox.pack(fill=tk.BOTH, expand=True, pady=(3, 5))
+        for i, name in enumerate(sorted(self.connections.get("sources", {}))):
+            listbox.insert(tk.END, name)
+            if name in cfg["sources"]:
+                listbox.selection_set(i)
+
+        tag_frame = ttk.Frame(frame)
+        tag_frame.pack(fill=tk.X, pady=(8, 0))
+        ttk.Label(tag_frame, text="Колонка тега источника:").pack(side=tk.LEFT)
+        tag_var = tk.StringVar(value=cfg["tag_column"])
+        ttk.Entry(tag_frame, textvariable=tag_var, width=20).pack(side=tk.LEFT, padx=5)
+
+        def on_apply():
+            tag = tag_var.get().strip()
+            if tag and not re.fullmatch(r"\w+", tag):
+                messagebox.showwarning("Ошибка", "Недопустимое имя колонки", parent=dlg)
+                return
+            current = self.source_combo.get()
+            self.connections["multisource"] = {
+                "sources": [listbox.get(i) for i in listbox.curselection()
+                            if listbox.get(i) != current],
+                "tag_column": tag,
+            }
+            self._save_connections()
+            self._refresh_multisource_label()
+            dlg.destroy()
+            names = self.connections["multisource"]["sources"]
+            self._log(f"Доп. источники: {', '.join(names) if names else 'нет'}"
+                      + (f", тег `{tag}`" if tag else ""))
+
+        btn_frame = ttk.Frame(frame)
+        btn_frame.pack(pady=(12, 0))
+        ttk.Button(btn_frame, text="Применить", command=on_apply).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="Отмена", command=dlg.destroy).pack(side=tk.LEFT, padx=5)
+
+    def _connect_extra_sources(self, exclude: str) -> list[tuple[str, ConnectionPool]]:
+        """Connection pools for the extra sources; unreachable ones are skipped."""
+        sources = []
+        known = self.connections.get("sources", {})
+        for name in self._multisource_config()["sources"]:
+            if name == exclude:
+                continue
+            params = known[name]
+            try:
+                client = self._make_client_from_params(params)
+            except Exception as e:
+                self._log(f"Источник '{name}' недоступен, пропущен: {e}", "ERROR")
+                continue
+            sources.append((name, ConnectionPool(
+                lambda p=params: self._make_client_from_params(p), [client])))
+        return sources
+
+    @staticmethod
+    def _sql_string(value: str) -> str:
+        return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+    @classmethod
+    def _tag_select(cls, select_sql: str, tag_column: str, source_name: str) -> str:
+        """Wrap SELECT so the server appends a constant source-tag column."""
+        return f"SELECT *, {cls._sql_string(source_name)} AS `{tag_column}` FROM ({select_sql})"
+
+    @staticmethod
+    def _inject_tag_column(ddl: str, tag_column: str) -> str:
+        """Add the source-tag column first in a CREATE TABLE column list."""
+        match = re.match(r"\s*CREATE\s+(?:OR\s+REPLACE\s+)?TABLE\s+[^(]+?\s*\(", ddl, re.I)
+        if not match or re.match(rf"\s*`?{re.escape(tag_column)}`?\s", ddl[match.end():]):
+            return ddl
+        return f"{ddl[:match.end()]}\n    `{tag_column}` LowCardinality(String),{ddl[match.end():]}"
 
     # ── Schema Tree ──────────────────────────────────────────────────
 
@@ -808,30 +2356,19 @@ class CHMigrateApp:
             self._show_ddl_preview(db, table)
             self._update_date_columns()
 
+    def _get_object_type(self, database: str, table: str) -> Optional[str]:
+        """'table' / 'view' / 'dictionary' as shown in the schema tree."""
+        for item_id, (d, t) in self.tree_item_map.items():
+            if d == database and t == table:
+                return self.schema_tree.item(item_id, "values")[0]
+        return None
+
     def _show_ddl_preview(self, database: str, table: str):
         key = (database, table)
         if key not in self.table_ddls:
             try:
-                tbl_type = None
-                for item_id, (d, t) in self.tree_item_map.items():
-                    if d == database and t == table:
-                        tbl_type = self.schema_tree.item(item_id, "values")[0]
-                        break
-
-                if tbl_type == "dictionary":
-                    ddl = self.source_client.command(
-                        f"SHOW CREATE DICTIONARY `{database}`.`{table}`"
-                    )
-                else:
-                    ddl = self.source_client.command(
-                        f"SHOW CREATE TABLE `{database}`.`{table}`"
-                    )
-                if isinstance(ddl, str):
-                    ddl = (ddl.replace("\\n", "\n")
-                              .replace("\\'", "'")
-                              .replace("\\t", "\t")
-                              .replace("\\\\", "\\"))
-                self.table_ddls[key] = ddl
+                self.table_ddls[key] = self._show_create(
+                    self.source_client, database, table, self._get_object_type(database, table))
             except Exception as e:
                 self.table_ddls[key] = f"-- Error: {e}"
 
@@ -839,11 +2376,22 @@ class CHMigrateApp:
         self.ddl_text.delete("1.0", tk.END)
         self.ddl_text.insert("1.0", self.table_ddls[key])
 
-    def _get_columns(self, database: str, table: str) -> list[dict]:
+    @staticmethod
+    def _show_create(client, database: str, table: str, tbl_type: Optional[str]) -> str:
+        kind = "DICTIONARY" if tbl_type == "dictionary" else "TABLE"
+        ddl = client.command(f"SHOW CREATE {kind} `{database}`.`{table}`")
+        if isinstance(ddl, str):
+            ddl = (ddl.replace("\\n", "\n")
+                      .replace("\\'", "'")
+                      .replace("\\t", "\t")
+                      .replace("\\\\", "\\"))
+        return ddl
+
+    def _get_columns(self, database: str, table: str, client=None) -> list[dict]:
         key = (database, table)
         if key not in self.table_columns:
             try:
-                rows = self.source_client.query(
+                rows = (client or self.source_client).query(
                     "SELECT name, type FROM system.columns "
                     "WHERE database = %(db)s AND table = %(tbl)s ORDER BY position",
                     parameters={"db": database, "tbl": table},
@@ -975,6 +2523,617 @@ class CHMigrateApp:
         ddl = re.sub(r"Replicated(\w*MergeTree)", r"\1", ddl)
         return ddl
 
+    # ── Deferred Indexes & Projections ───────────────────────────────
+
+    @staticmethod
+    def _split_definitions(text: str, start: int) -> tuple[list[str], int]:
+        """Split a parenthesized definition list at text[start] == '(' by top-level commas.
+
+        Quotes and backticks are respected. Returns (items, index of closing paren).
+        """
+        items, depth, quote, item_start = [], 0, None, start + 1
+        pos = start
+        while pos < len(text):
+            ch = text[pos]
+            if quote:
+                if ch == "\\":
+                    pos += 1
+                elif ch == quote:
+                    quote = None
+            elif ch in "'`\"":
+                quote = ch
+            elif ch == "(":
+                depth += 1
+            elif ch == ")":
+                depth -= 1
+                if depth == 0:
+                    items.append(text[item_start:pos])
+                    return items, pos
+            elif ch == "," and depth == 1:
+                items.append(text[item_start:pos])
+                item_start = pos + 1
+            pos += 1
+        return items, -1
+
+    @classmethod
+    def _strip_indexes_and_projections(cls, ddl: str) -> tuple[str, list[str]]:
+        """Remove INDEX / PROJECTION definitions from a CREATE TABLE column list.
+
+        Returns (ddl without them, removed clauses) so they can be re-added with
+        ALTER TABLE ADD ... after a bulk load.
+        """
+        match = re.match(r"\s*CREATE\s+(?:OR\s+REPLACE\s+)?TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?[^(]+?\(", ddl, re.I)
+        if not match:
+            return ddl, []
+        items, end = cls._split_definitions(ddl, match.end() - 1)
+        if end < 0:
+            return ddl, []
+        keep, removed = [], []
+        for item in items:
+            if re.match(r"\s*(?:INDEX|PROJECTION)\s", item):
+                removed.append(item.strip())
+            else:
+                keep.append(item)
+        if not removed or not keep:
+            return ddl, []
+        body = ",".join(keep).rstrip() + "\n"
+        return ddl[:match.end()] + body + ddl[end:], removed
+
+    def _add_deferred_clauses(self, client, db: str, table: str, clauses: list[str], prefix: str = ""):
+        """ALTER TABLE ADD INDEX/PROJECTION, then MATERIALIZE them as mutations."""
+        full_name = f"`{db}`.`{table}`"
+        for clause in clauses:
+            kind, name = re.match(r"\s*(\w+)\s+(`[^`]+`|[\w$]+)", clause).groups()
+            try:
+                client.command(f"ALTER TABLE {full_name} ADD {clause}")
+                client.command(f"ALTER TABLE {full_name} MATERIALIZE {kind.upper()} {name}")
+                self._log(f"  {prefix}{full_name}: добавлен и материализуется {kind.upper()} {name}")
+            except Exception as e:
+                self._log(f"  {prefix}ОШИБКА {kind.upper()} {name} для {full_name}: {e}", "ERROR")
+
+    def _restore_deferred_clauses(self, pending: dict[tuple[str, str], list[str]]):
+        """Re-add the deferred clauses of tables a stopped run never reached.
+
+        The DDL created those tables without them; ADD INDEX/PROJECTION also
+        works on a partially loaded table. Tables that still lack them are logged.
+        """
+        tables = ", ".join(f"`{db}`.`{table}`" for db, table in pending)
+        self._log(f"Возврат отложенных INDEX/PROJECTION: {tables}", "WARN")
+        try:
+            targets = self._connect_fanout_targets(include_primary=True)
+        except Exception as e:
+            self._log(f"ОШИБКА подключения, INDEX/PROJECTION не возвращены в {tables}: {e}", "ERROR")
+            return
+        for (db, table), clauses in pending.items():
+            for name, client in targets:
+                prefix = f"[{name}] " if len(targets) > 1 else ""
+                self._add_deferred_clauses(client, db, table, clauses, prefix)
+
+    def _wait_mutations(self, watched: list[tuple[str, object, str, str]], job: Optional[Job] = None):
+        """Poll system.mutations until MATERIALIZE mutations of the watched tables finish."""
+        pending = list(watched)
+        while pending:
+            if job is not None:
+                job.check()
+            still = []
+            for name, client, db, table in pending:
+                prefix = f"[{name}] " if name != "Destination" else ""
+                try:
+                    rows = client.query(
+                        "SELECT count(), sum(parts_to_do), any(latest_fail_reason) FROM system.mutations "
+                        "WHERE database = %(db)s AND table = %(tbl)s AND NOT is_done",
+                        parameters={"db": db, "tbl": table},
+                    ).result_rows
+                except Exception as e:
+                    self._log(f"  {prefix}Не удалось прочитать system.mutations: {e}", "WARN")
+                    continue
+                count, parts, fail = rows[0] if rows else (0, 0, "")
+                if count:
+                    still.append((name, client, db, table))
+                    fail_note = f", ошибка: {fail}" if fail else ""
+                    self._log(f"  {prefix}`{db}`.`{table}`: материализация, осталось частей {parts}{fail_note}")
+                else:
+                    self._log(f"  {prefix}`{db}`.`{table}`: индексы и проекции материализованы")
+            pending = still
+            if pending:
+                time.sleep(PROGRESS_LOG_INTERVAL)
+
+    # ── Column Transforms ────────────────────────────────────────────
+
+    def _show_transforms_dialog(self):
+        """Edit per-table transform specs (JSON, stored in connections.json)."""
+        transforms = dict(self.connections.get("transforms", {}))
+        for db, table in sorted(self.selected_tables):
+            transforms.setdefault(f"{db}.{table}", {op: [] for op in ("drop", "hash", "null")})
+
+        dlg = tk.Toplevel(self.root)
+        dlg.title("Трансформации колонок")
+        dlg.geometry("620x480")
+        dlg.transient(self.root)
+
+        frame = ttk.Frame(dlg, padding=10)
+        frame.pack(fill=tk.BOTH, expand=True)
+        ttk.Label(frame, justify=tk.LEFT, text=(
+            '{"db.table": {"keep": [...], "drop": [...], "rename": {"old": "new"},\n'
+            '  "hash": [...], "null": [...], "constant": {"col": value}, "cast": {"col": "Type"}}}'
+        )).pack(anchor="w")
+
+        text = tk.Text(frame, wrap=tk.NONE)
+        text.pack(fill=tk.BOTH, expand=True, pady=5)
+        text.insert("1.0", json.dumps(transforms, indent=2, ensure_ascii=False))
+
+        def on_save():
+            try:
+                specs = json.loads(text.get("1.0", tk.END))
+                for name, spec in specs.items():
+                    unknown = set(spec) - set(TRANSFORM_OPS)
+                    if unknown:
+                        raise ValueError(f"{name}: неизвестные операции {sorted(unknown)}")
+                    self._check_transform(name, spec)
+            except (ValueError, AttributeError) as e:
+                messagebox.showwarning("Ошибка", f"Некорректная спецификация: {e}", parent=dlg)
+                return
+            # Drop empty template entries
+            self.connections["transforms"] = {
+                name: spec for name, spec in specs.items() if any(spec.values())
+            }
+            self._save_connections()
+            dlg.destroy()
+            self._log(f"Трансформации сохранены для {len(self.connections['transforms'])} таблиц")
+
+        btn_frame = ttk.Frame(frame)
+        btn_frame.pack()
+        ttk.Button(btn_frame, text="Сохранить", command=on_save).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="Отмена", command=dlg.destroy).pack(side=tk.LEFT, padx=5)
+
+    def _check_transform(self, name: str, spec: dict):
+        """Raise ValueError for hashes of unhashable types and keys on removed columns.
+
+        Needs the source columns (and the DDL, once generated); unknown tables
+        are checked when the DDL and the SELECTs are built.
+        """
+        db, _, table = name.partition(".")
+        columns = self._get_columns(db, table) if self.source_client else []
+        types = {col["name"]: col["type"] for col in columns}
+        for col_name in spec.get("hash", []):
+            if col_name in types and self._hash_expr(f"`{col_name}`", types[col_name]) is None:
+                raise ValueError(f"{name}: колонку `{col_name}` типа {types[col_name]} нельзя хэшировать")
+        ddl = self.table_ddls.get((db, table), "")
+        if columns and ddl.lstrip().upper().startswith("CREATE TABLE"):
+            try:
+                self._apply_transform_to_ddl(ddl, spec, columns)
+            except ValueError as e:
+                raise ValueError(f"{name}: {e}") from None
+
+    @staticmethod
+    def _sql_literal(value) -> str:
+        if value is None:
+            return "NULL"
+        if isinstance(value, bool):
+            return "1" if value else "0"
+        if isinstance(value, (int, float)):
+            return repr(value)
+        return CHMigrateApp._sql_string(str(value))
+
+    @staticmethod
+    def _hash_expr(ref: str, col_type: str) -> Optional[str]:
+        """Digest of `ref` that fits its own type, or None if the type cannot be hashed.
+
+        The base type under LowCardinality/Nullable picks the hash: strings get a
+        hex SHA-256, FixedString(N) and UUID its first bytes, integers sipHash64
+        wrapped to their width. NULLs stay NULL.
+        """
+        base = col_type
+        for wrapper in ("LowCardinality", "Nullable"):
+            m = re.fullmatch(rf"{wrapper}\((.*)\)", base)
+            if m:
+                base = m.group(1)
+        fixed = re.fullmatch(r"FixedString\((\d+)\)", base)
+        if base == "String":
+            digest = f"hex(SHA256({ref}))"
+        elif fixed:
+            size = int(fixed.group(1))
+            if size > 64:
+                return None
+            digest = f"toFixedString(substring(hex(SHA256({ref})), 1, {size}), {size})"
+        elif base == "UUID":
+            digest = f"reinterpretAsUUID(substring(SHA256(toString({ref})), 1, 16))"
+        elif re.fullmatch(r"U?Int(8|16|32|64|128|256)", base):
+            digest = f"sipHash64({ref})"
+        else:
+            return None
+        return f"CAST({digest} AS {col_type})"
+
+    @classmethod
+    def _transform_expr(cls, name: str, col_type: str, spec: dict) -> str:
+        """Server-side expression for one output column."""
+        ref = f"__src.`{name}`"
+        if name in spec.get("hash", []):
+            expr = cls._hash_expr(ref, col_type)
+            if expr is None:
+                raise ValueError(f"колонку `{name}` типа {col_type} нельзя хэшировать")
+        elif name in spec.get("null", []):
+            expr = f"CAST(NULL AS {col_type})" if col_type.startswith("Nullable") \
+                else f"defaultValueOfArgumentType({ref})"
+        elif name in spec.get("constant", {}):
+            expr = f"CAST({cls._sql_literal(spec['constant'][name])} AS {col_type})"
+        else:
+            expr = ref
+        if name in spec.get("cast", {}):
+            expr = f"CAST({expr} AS {spec['cast'][name]})"
+        return expr
+
+    @classmethod
+    def _transform_select(cls, select_sql: str, spec: dict, columns: list[tuple[str, str]]) -> str:
+        """Push a transform spec into the SELECT so the server applies it to whole blocks.
+
+        `columns` is the (name, type) list of the original SELECT result.
+        """
+        keep = spec.get("keep")
+        drop = set(spec.get("drop", []))
+        rename = spec.get("rename", {})
+        exprs = [
+            f"{cls._transform_expr(name, col_type, spec)} AS `{rename.get(name, name)}`"
+            for name, col_type in columns
+            if (not keep or name in keep) and name not in drop
+        ]
+        return f"SELECT {', '.join(exprs)} FROM ({select_sql}) AS __src"
+
+    @staticmethod
+    def _describe_select(client, select_sql: str) -> list[tuple[str, str]]:
+        rows = client.query(f"DESCRIBE ({select_sql})").result_rows
+        return [(r[0], r[1]) for r in rows]
+
+    @classmethod
+    def _apply_transform_to_ddl(cls, ddl: str, spec: dict, columns: list[dict]) -> str:
+        """Mirror keep/drop/rename/cast of a transform spec in CREATE TABLE.
+
+        Renamed columns are renamed in defaults, INDEX/PROJECTION definitions,
+        the engine arguments and the PARTITION BY / ORDER BY / PRIMARY KEY /
+        SAMPLE BY / TTL clauses too, wherever they stand as whole identifiers:
+        string literals, comments, function names and dotted subfields are
+        left alone, and clauses may span several lines.
+        Raises ValueError if any of those refers to a column the spec removes.
+        """
+        keep = spec.get("keep")
+        rename = spec.get("rename", {})
+        cast = spec.get("cast", {})
+        types = {col["name"]: col["type"] for col in columns}
+        removed = {name for name in types if (keep and name not in keep) or name in spec.get("drop", [])}
+        match = re.match(r"\s*CREATE\s+(?:OR\s+REPLACE\s+)?TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?[^(]+?\(", ddl, re.I)
+        items, end = cls._split_definitions(ddl, match.end() - 1) if match else ([], -1)
+        if end < 0:
+            return ddl
+
+        def _rewrite(text: str) -> str:
+            def _sub(m):
+                name = m.group("quoted") if m.group("quoted") is not None else m.group("word")
+                if name is None or name not in removed and name not in rename:
+                    return m.group(0)
+                before = text[:m.start()].rstrip()
+                after = text[m.end():].lstrip()
+                if before.endswith(".") or (m.group("word") and after.startswith("(")):
+                    return m.group(0)
+                if name in removed:
+                    raise ValueError(f"колонка `{name}` удаляется, но используется в: {' '.join(text.split())}")
+                return f"`{rename[name]}`"
+            return SQL_TOKEN.sub(_sub, text)
+
+        definitions = []
+        for item in items:
+            head = re.match(r"(\s*)(`(?:[^`\\]|\\.)*`|[A-Za-z_]\w*)(\s+)", item)
+            if not head:
+                definitions.append(item)
+                continue
+            name = head.group(2)[1:-1] if head.group(2).startswith("`") else head.group(2)
+            rest = item[head.end():]
+            if head.group(2).upper() in ("INDEX", "PROJECTION", "CONSTRAINT"):
+                # Keep the index / projection name, rewrite its expression
+                label = re.match(r"(`(?:[^`\\]|\\.)*`|\w+)", rest)
+                definitions.append(item[:head.end() + label.end()] + _rewrite(rest[label.end():]))
+                continue
+            if name in removed:
+                continue
+            col_type = types.get(name)
+            if col_type is None or not rest.startswith(col_type):
+                if name in cast:
+                    raise ValueError(f"не найден тип колонки `{name}` в DDL")
+                definitions.append(item[:head.end()] + _rewrite(rest))
+                continue
+            new_name = f"`{rename[name]}`" if name in rename else head.group(2)
+            definitions.append(f"{head.group(1)}{new_name}{head.group(3)}{cast.get(name, col_type)}"
+                               f"{_rewrite(rest[len(col_type):])}")
+        if not definitions:
+            raise ValueError("в таблице не остаётся колонок")
+        # The closing ')' stays on its own line when the last definition goes
+        definitions[-1] = definitions[-1].rstrip() + re.search(r"\s*$", items[-1]).group(0)
+
+        tail = ddl[end + 1:]
+        masked = SQL_TOKEN.sub(lambda m: m.group(0) if m.group("word") else " " * len(m.group(0)), tail)
+        depth, cuts = 0, []
+        for m in re.finditer(r"[()]|\b(ENGINE|PARTITION\s+BY|PRIMARY\s+KEY|ORDER\s+BY|SAMPLE\s+BY|TTL|"
+                             r"SETTINGS|COMMENT)\b", masked, re.I):
+            if m.group(0) in "()":
+                depth += 1 if m.group(0) == "(" else -1
+            elif depth == 0:
+                cuts.append((m.start(), " ".join(m.group(1).upper().split())))
+        parts = [tail[:cuts[0][0]] if cuts else tail]
+        for (start, keyword), (stop, _) in zip(cuts, cuts[1:] + [(len(tail), "")]):
+            segment = tail[start:stop]
+            parts.append(segment if keyword in ("SETTINGS", "COMMENT") else _rewrite(segment))
+        return ddl[:match.end()] + ",".join(definitions) + ")" + "".join(parts)
+
+    # ── DDL Dependencies ─────────────────────────────────────────────
+
+    @staticmethod
+    def _parse_object_name(name: str, default_db: str) -> tuple[str, str]:
+        """Split `db`.`table` / db.table / table into (database, table)."""
+        parts = re.findall(r"`([^`]+)`|([\w$]+)", name)
+        idents = [q or p for q, p in parts]
+        if len(idents) >= 2:
+            return idents[0], idents[1]
+        return default_db, idents[0] if idents else ""
+
+    @classmethod
+    def _parse_ddl_references(cls, database: str, create_query: str) -> set[tuple[str, str]]:
+        """Objects referenced by a view / materialized view / dictionary DDL.
+
+        Covers MV `TO` targets, FROM/JOIN sources of the SELECT part and
+        ClickHouse dictionary sources (SOURCE(CLICKHOUSE(... DB '..' TABLE '..'))).
+        """
+        refs: set[tuple[str, str]] = set()
+        ident = r"(?:`[^`]+`|[\w$]+)(?:\s*\.\s*(?:`[^`]+`|[\w$]+))?"
+
+        if re.match(r"\s*CREATE\s+(?:OR\s+REPLACE\s+)?(?:MATERIALIZED\s+)?VIEW", create_query, re.I):
+            select_pos = re.search(r"\sAS\s+(?:SELECT|WITH)\b", create_query, re.I)
+            header = create_query[:select_pos.start()] if select_pos else create_query
+            body = create_query[select_pos.start():] if select_pos else ""
+            to_match = re.search(rf"\bTO\s+({ident})", header, re.I)
+            if to_match:
+                refs.add(cls._parse_object_name(to_match.group(1), database))
+            for m in re.finditer(rf"\b(?:FROM|JOIN)\s+({ident})", body, re.I):
+                refs.add(cls._parse_object_name(m.group(1), database))
+
+        source = re.search(r"SOURCE\s*\(\s*CLICKHOUSE\s*\((.*?)\)\s*\)", create_query, re.I | re.S)
+        if source:
+            args = source.group(1)
+            tbl = re.search(r"\bTABLE\s+'([^']+)'", args, re.I)
+            db = re.search(r"\bDB\s+'([^']+)'", args, re.I)
+            if tbl:
+                refs.add((db.group(1) if db else database, tbl.group(1)))
+        return refs
+
+    def _load_dependency_graph(self, objects: set[tuple[str, str]],
+                               rows: list[tuple]) -> dict[tuple[str, str], set[tuple[str, str]]]:
+        """Build {object: objects it depends on}, restricted to the given objects.
+
+        Uses system.tables.dependencies_* (tables -> MVs reading from them)
+        plus create_table_query parsing for TO targets and dictionary sources.
+        `rows` come from _load_table_metadata.
+        """
+        deps: dict[tuple[str, str], set[tuple[str, str]]] = {key: set() for key in objects}
+        for db, name, _, dep_dbs, dep_tables, create_query in rows:
+            key = (db, name)
+            for dependent in zip(dep_dbs, dep_tables):
+                if key in deps and dependent in deps and dependent != key:
+                    deps[dependent].add(key)
+            if key in deps:
+                for ref in self._parse_ddl_references(db, create_query):
+                    if ref in deps and ref != key:
+                        deps[key].add(ref)
+        return deps
+
+    @staticmethod
+    def _topological_waves(deps: dict[tuple[str, str], set[tuple[str, str]]]) -> list[list[tuple[str, str]]]:
+        """Group objects into waves: every object depends only on earlier waves.
+
+        Objects left in a dependency cycle are emitted together in a final wave.
+        """
+        remaining = {key: set(d) for key, d in deps.items()}
+        waves: list[list[tuple[str, str]]] = []
+        while remaining:
+            ready = sorted(key for key, d in remaining.items() if not d)
+            if not ready:
+                waves.append(sorted(remaining))
+                break
+            waves.append(ready)
+            for key in ready:
+                del remaining[key]
+            for d in remaining.values():
+                d.difference_update(ready)
+        return waves
+
+    # ── Bulk DDL Fetch ───────────────────────────────────────────────
+
+    def _load_table_metadata(self, client, databases: set[str]) -> tuple[list[tuple], bool]:
+        """system.tables rows (database, name, engine, dependencies_database,
+        dependencies_table, create_table_query) for the given databases.
+
+        create_table_query is stored on one line; servers with formatQuery
+        return it laid out like SHOW CREATE so the line-based DDL rewrites
+        keep working. The flag tells whether that happened.
+        """
+        sql = ("SELECT database, name, engine, dependencies_database, dependencies_table, {ddl} "
+               "FROM system.tables WHERE database IN %(dbs)s")
+        params = {"dbs": tuple(sorted(databases))}
+        try:
+            rows = client.query(
+                sql.format(ddl="if(create_table_query = '', '', formatQuery(create_table_query))"),
+                parameters=params,
+                # formatQuery throws on an empty string, so only evaluate the non-empty branch
+                settings={"short_circuit_function_evaluation": "force_enable"},
+            ).result_rows
+            return rows, True
+        except Exception as e:
+            self._log(f"formatQuery недоступна, DDL будет получен через SHOW CREATE: {e}", "WARN")
+        rows = client.query(sql.format(ddl="create_table_query"), parameters=params).result_rows
+        return rows, False
+
+    def _fetch_ddls(self, pool: ConnectionPool, objects: set[tuple[str, str]],
+                    object_types: dict[tuple[str, str], Optional[str]]) -> list[tuple]:
+        """Fill self.table_ddls for all objects in one system.tables query.
+
+        Objects without a usable create_table_query (XML-defined dictionaries,
+        servers without formatQuery) fall back to SHOW CREATE in parallel.
+        Returns the system.tables rows for the dependency graph.
+        """
+        with pool.connection() as client:
+            rows, formatted = self._load_table_metadata(client, {db for db, _ in objects})
+
+        engines: dict[tuple[str, str], str] = {}
+        for db, name, engine, _, _, create_query in rows:
+            key = (db, name)
+            engines[key] = engine
+            if formatted and create_query and key in objects and key not in self.table_ddls:
+                self.table_ddls[key] = create_query
+
+        missing = sorted(key for key in objects if key not in self.table_ddls)
+        if not missing:
+            return rows
+
+        def _fetch(key: tuple[str, str]):
+            db, table = key
+            tbl_type = "dictionary" if engines.get(key) == "Dictionary" else object_types.get(key)
+            try:
+                with pool.connection() as client:
+                    self.table_ddls[key] = self._show_create(client, db, table, tbl_type)
+            except Exception as e:
+                self.table_ddls[key] = f"-- Error: {e}"
+
+        self._log(f"SHOW CREATE для {len(missing)} объектов")
+        with ThreadPoolExecutor(max_workers=min(DDL_PARALLELISM, len(missing))) as executor:
+            list(executor.map(_fetch, missing))
+        return rows
+
+    # ── Schema Diff ──────────────────────────────────────────────────
+
+    def _load_schema(self, client, databases: set[str]) -> dict[tuple[str, str], dict]:
+        """Tables, columns and skipping indexes of the given databases in three queries.
+
+        Returns {(db, table): {"engine" (engine_full without TTL), "keys", "sorting_key", "ttl",
+        "columns": {name: definition} in column order, "indexes": {name: definition}}};
+        definitions are built from system.columns / system.data_skipping_indices,
+        so equal definitions mean equal columns and indexes on both servers.
+        """
+        params = {"dbs": tuple(sorted(databases))}
+        schema: dict[tuple[str, str], dict] = {}
+        for db, name, engine_full, sorting_key, partition_key, primary_key, create_query in client.query(
+                "SELECT database, name, engine_full, sorting_key, partition_key, primary_key, create_table_query "
+                "FROM system.tables WHERE database IN %(dbs)s", parameters=params).result_rows:
+            # TTL is diffed on its own (MODIFY TTL), everything else in engine_full needs a new table
+            engine = re.sub(r"\s+TTL\s+.+?(?=\s+SETTINGS\s|$)", "", " ".join(engine_full.split()))
+            schema[(db, name)] = {"engine": engine, "keys": (sorting_key, partition_key, primary_key),
+                                  "sorting_key": sorting_key, "ttl": self._table_ttl(create_query),
+                                  "columns": {}, "indexes": {}}
+        for db, table, name, col_type, default_kind, default_expr, codec, comment in client.query(
+                "SELECT database, table, name, type, default_kind, default_expression, compression_codec, comment "
+                "FROM system.columns WHERE database IN %(dbs)s ORDER BY database, table, position",
+                parameters=params).result_rows:
+            if (db, table) in schema:
+                schema[(db, table)]["columns"][name] = self._column_definition(
+                    name, col_type, default_kind, default_expr, codec, comment)
+        for db, table, name, expr, index_type, granularity in client.query(
+                "SELECT database, table, name, expr, type_full, granularity "
+                "FROM system.data_skipping_indices WHERE database IN %(dbs)s", parameters=params).result_rows:
+            if (db, table) in schema:
+                schema[(db, table)]["indexes"][name] = (f"INDEX `{name}` {expr} TYPE {index_type} "
+                                                        f"GRANULARITY {granularity}")
+        return schema
+
+    @classmethod
+    def _column_definition(cls, name: str, col_type: str, default_kind: str, default_expr: str,
+                           codec: str, comment: str) -> str:
+        """Column definition for ALTER ADD/MODIFY COLUMN from system.columns fields."""
+        definition = f"`{name}` {col_type}"
+        if default_kind:
+            definition += f" {default_kind} {default_expr}"
+        if codec:
+            definition += f" {codec}"
+        if comment:
+            definition += f" COMMENT {cls._sql_string(comment)}"
+        return definition
+
+    @classmethod
+    def _table_ttl(cls, create_query: str) -> str:
+        """Table TTL clause of create_table_query with whitespace collapsed, '' if none.
+
+        Only the part after the column list is searched, so column TTLs do not count.
+        """
+        match = re.match(r"\s*CREATE\s+(?:OR\s+REPLACE\s+)?TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?[^(]+?\(",
+                         create_query, re.I)
+        if not match:
+            return ""
+        _, end = cls._split_definitions(create_query, match.end() - 1)
+        if end < 0:
+            return ""
+        ttl = re.search(r"\bTTL\s+(.+?)(?=\s+SETTINGS\s|\s+COMMENT\s|$)", create_query[end + 1:], re.I | re.S)
+        return " ".join(ttl.group(1).split()) if ttl else ""
+
+    @classmethod
+    def _schema_alter(cls, source: dict, dest: dict, keep: set[str]) -> Optional[tuple[list[str], list[str]]]:
+        """ALTER TABLE commands that turn the destination table into the source one.
+
+        Returns (commands, added column names), or None when the engine (with
+        its arguments and settings) or a key differs, which ALTER cannot
+        change. The destination engine may also be the one the generated DDL
+        creates from a Replicated source engine. Columns in `keep` exist only on
+        the destination (the source-tag column) and are never dropped.
+        Commands are ordered so nothing is dropped while an index or TTL still
+        refers to it and new indexes are built over the final columns.
+        """
+        created = cls._clean_replicated_engine(f"ENGINE = {source['engine']}")[len("ENGINE = "):]
+        if dest["engine"] not in (source["engine"], created) or source["keys"] != dest["keys"]:
+            return None
+        drop_indexes, columns, add_indexes, added = [], [], [], []
+        for name, definition in dest["indexes"].items():
+            if source["indexes"].get(name) != definition:
+                drop_indexes.append(f"DROP INDEX `{name}`")
+        for name, definition in source["indexes"].items():
+            if dest["indexes"].get(name) != definition:
+                add_indexes += [f"ADD {definition}", f"MATERIALIZE INDEX `{name}`"]
+        previous = None
+        for name, definition in source["columns"].items():
+            current = dest["columns"].get(name)
+            if current is None:
+                columns.append(f"ADD COLUMN {definition} " + (f"AFTER `{previous}`" if previous else "FIRST"))
+                added.append(name)
+            elif current != definition:
+                columns.append(f"MODIFY COLUMN {definition}")
+            previous = name
+        if source["ttl"] != dest["ttl"]:
+            columns.append(f"MODIFY TTL {source['ttl']}" if source["ttl"] else "REMOVE TTL")
+        columns += [f"DROP COLUMN `{name}`" for name in dest["columns"]
+                    if name not in source["columns"] and name not in keep]
+        return drop_indexes + columns + add_indexes, added
+
+    def _schema_diff_ddl(self, db: str, table: str, source: dict, dests: list[dict],
+                         keep: set[str]) -> Optional[str]:
+        """One ALTER TABLE for a table that already exists on every destination.
+
+        Returns '' when the schemas match and None when the table has to be
+        recreated, which includes fan-out targets whose schemas have drifted
+        apart (the same DDL script runs on all of them) and added columns:
+        the kept rows are not copied again, so they would never get values.
+        """
+        diffs = [self._schema_alter(source, dest, keep) for dest in dests]
+        full_name = f"`{db}`.`{table}`"
+        if any(diff is None for diff in diffs):
+            self._log(f"{full_name}: движок или ключи различаются, таблица будет пересоздана", "WARN")
+            return None
+        if any(diff != diffs[0] for diff in diffs[1:]):
+            self._log(f"{full_name}: схемы на destination различаются, таблица будет пересоздана", "WARN")
+            return None
+        commands, added = diffs[0]
+        if added:
+            self._log(f"{full_name}: новые колонки {', '.join(f'`{name}`' for name in added)}, "
+                      f"таблица будет пересоздана", "WARN")
+            return None
+        if not commands:
+            self._log(f"{full_name}: схема совпадает с destination")
+            return ""
+        self._log(f"{full_name}: ALTER вместо пересоздания ({len(commands)} изменений)")
+        return f"ALTER TABLE {full_name}\n    " + ",\n    ".join(commands)
+
     # ── DDL Generation & Execution ───────────────────────────────────
 
     def _generate_ddl(self):
@@ -985,27 +3144,136 @@ class CHMigrateApp:
             self._log("Source не подключён", "ERROR")
             return
 
-        ddl_scripts: list[str] = ["SET allow_suspicious_low_cardinality_types=1;"]
-        databases_seen: set[str] = set()
+        objects = set(self.selected_tables)
+        object_types = {key: self._get_object_type(*key) for key in objects}
+        source_params = dict(self.source_params)
+        tag_column = self._multisource_config()["tag_column"]
+        transforms = self.connections.get("transforms", {})
+        options = self._migration_options()
+        # Staging loads swap the table in at the end, so keep the live one intact
+        create_table = "CREATE TABLE IF NOT EXISTS" if options["staging"] else "CREATE OR REPLACE TABLE"
+        # ALTERs only where every fan-out target agrees, DDL runs on all of them
+        dest_endpoints = self._run_endpoints(sources=False) if options["schema_diff"] and self.dest_client else None
+
+        def _do(job: Job):
+            # Own connection: the preview keeps using source_client on the UI thread
+            pool = ConnectionPool(lambda: self._make_client_from_params(source_params))
+            try:
+                rows = self._fetch_ddls(pool, objects, object_types)
+            except Exception as e:
+                self._log(f"Ошибка получения DDL: {e}", "ERROR")
+                return
 
-        for db, table in sorted(self.selected_tables):
-            if db not in databases_seen:
+            try:
+                waves = self._topological_waves(self._load_dependency_graph(objects, rows))
+            except Exception as e:
+                self._log(f"Не удалось построить граф зависимостей, порядок по алфавиту: {e}", "WARN")
+                waves = [sorted(objects)]
+            job.check()
+
+            # Tables that exist on destination get ALTERs instead of CREATE OR REPLACE
+            source_schema, dest_schemas = {}, []
+            if dest_endpoints is not None:
+                databases = {db for db, _ in objects}
+                try:
+                    with pool.connection() as client:
+                        source_schema = self._load_schema(client, databases)
+                    dest_schemas = [self._load_schema(self._make_client_from_params(params), databases)
+                                    for _, params in dest_endpoints]
+                except Exception as e:
+                    self._log(f"Не удалось сравнить схемы с destination, DDL через CREATE: {e}", "WARN")
+                    source_schema, dest_schemas = {}, []
+            job.check()
+
+            ddl_scripts: list[str] = ["SET allow_suspicious_low_cardinality_types=1;"]
+            for db in sorted({db for db, _ in objects}):
                 ddl_scripts.append(f"CREATE DATABASE IF NOT EXISTS `{db}`;")
-                databases_seen.add(db)
 
-            key = (db, table)
-            if key not in self.table_ddls:
-                self._show_ddl_preview(db, table)
+            deferred_clauses: dict[tuple[str, str], list[str]] = {}
+            kept_tables: set[tuple[str, str]] = set()
+            with pool.connection() as client:
+                for wave_no, wave in enumerate(waves, 1):
+                    job.check()
+                    marker = f"{DDL_WAVE_MARKER} {wave_no}\n"
+                    for db, table in wave:
+                        key = (db, table)
+                        # Transformed tables differ from source by design, so they are still recreated
+                        if (key in source_schema and dest_schemas and all(key in ds for ds in dest_schemas)
+                                and object_types.get(key) == "table" and f"{db}.{table}" not in transforms):
+                            altered = self._schema_diff_ddl(db, table, source_schema[key],
+                                                            [ds[key] for ds in dest_schemas],
+                                                            {tag_column} if tag_column else set())
+                            if altered is not None:
+                                kept_tables.add(key)
+                                if altered:
+                                    ddl_scripts.append(marker + altered + ";")
+                                    marker = ""
+                                continue
+                        raw_ddl = self.table_ddls.get(key, "")
+                        cleaned = self._clean_replicated_engine(raw_ddl)
+                        cleaned = re.sub(r"^CREATE\s+TABLE", create_table, cleaned, count=1)
+                        if tag_column:
+                            cleaned = self._inject_tag_column(cleaned, tag_column)
+                        if f"{db}.{table}" in transforms:
+                            try:
+                                cleaned = self._apply_transform_to_ddl(
+                                    cleaned, transforms[f"{db}.{table}"], self._get_columns(db, table, client))
+                            except ValueError as e:
+                                self._log(f"`{db}`.`{table}`: трансформация несовместима с DDL, "
+                                          f"таблица пропущена: {e}", "ERROR")
+                                continue
+                        if options["defer_indexes"]:
+                            cleaned, deferred = self._strip_indexes_and_projections(cleaned)
+                            if deferred:
+                                deferred_clauses[key] = deferred
+                        ddl_scripts.append(marker + cleaned + ";")
+                        marker = ""
+
+            def _show():
+                self.deferred_clauses = deferred_clauses
+                self.kept_tables = kept_tables
+                self.ddl_mig_text.delete("1.0", tk.END)
+                self.ddl_mig_text.insert("1.0", "\n\n".join(ddl_scripts))
+
+            self.root.after(0, _show)
+            tables_list = ", ".join(f"`{db}`.`{t}`" for wave in waves for db, t in wave)
+            self._log(f"Сгенерирован DDL для {len(objects)} таблиц "
+                      f"({len(waves)} волн): {tables_list}")
+
+        return _do
 
-            raw_ddl = self.table_ddls.get(key, "")
-            cleaned = self._clean_replicated_engine(raw_ddl)
-            cleaned = re.sub(r"^CREATE\s+TABLE", "CREATE OR REPLACE TABLE", cleaned, count=1)
-            ddl_scripts.append(cleaned + ";")
+    @staticmethod
+    def _split_ddl_waves(ddl_text: str) -> tuple[list[str], list[list[str]]]:
+        """Split DDL script into (preamble statements, waves of statements).
 
-        self.ddl_mig_text.delete("1.0", tk.END)
-        self.ddl_mig_text.insert("1.0", "\n\n".join(ddl_scripts))
-        tables_list = ", ".join(f"`{db}`.`{t}`" for db, t in sorted(self.selected_tables))
-        self._log(f"Сгенерирован DDL для {len(self.selected_tables)} таблиц: {tables_list}")
+        A statement prefixed with a `-- WAVE N` line starts a new wave.
+        Without any markers every statement becomes its own wave, which keeps
+        hand-written scripts running strictly in order.
+        """
+        statements = [s.strip() for s in ddl_text.split(";") if s.strip()]
+        has_markers = any(s.startswith(DDL_WAVE_MARKER) for s in statements)
+        preamble: list[str] = []
+        waves: list[list[str]] = []
+        for stmt in statements:
+            if stmt.startswith(DDL_WAVE_MARKER):
+                waves.append([stmt.split("\n", 1)[1].strip() if "\n" in stmt else ""])
+            elif not has_markers:
+                waves.append([stmt])
+            elif waves:
+                waves[-1].append(stmt)
+            else:
+                preamble.append(stmt)
+        return preamble, [[s for s in w if s] for w in waves]
+
+    @staticmethod
+    def _parse_set_settings(statements: list[str]) -> dict:
+        """Collect `SET k=v` statements into a settings dict for worker connections."""
+        settings = {}
+        for stmt in statements:
+            m = re.match(r"SET\s+(\w+)\s*=\s*(.+)$", stmt, re.I | re.S)
+            if m:
+                settings[m.group(1)] = m.group(2).strip().strip("'")
+        return settings
 
     def _create_ddl_on_destination(self):
         if not self.dest_client:
@@ -1017,31 +3285,84 @@ class CHMigrateApp:
             self._log("Нет DDL для выполнения", "WARN")
             return
 
-        def _do():
-            self._set_buttons_state(False)
-            statements = [s.strip() for s in ddl_text.split(";") if s.strip()]
-
-            for i, stmt in enumerate(statements, 1):
+        objects = sorted(self.selected_tables)
+        # The data copy writes to every fan-out target too, so each gets the same DDL
+        destinations = self._run_endpoints(sources=False)
+        run_id = uuid.uuid4().hex[:8]
+
+        def _do(job: Job):
+            job.on_cancel(lambda: self._kill_run_queries(run_id, destinations))
+            preamble, waves = self._split_ddl_waves(ddl_text)
+            for name, params in destinations:
+                job.check()
+                prefix = f"[{name}] " if len(destinations) > 1 else ""
                 try:
-                    self.dest_client.command(stmt)
-                    self._log(f"Выполнено ({i}/{len(statements)}): {stmt[:80]}...")
+                    client = self.dest_client if name == "Destination" else self._make_client_from_params(params)
                 except Exception as e:
-                    self._log(f"ОШИБКА ({i}/{len(statements)}): {e}", "ERROR")
+                    self._log(f"{prefix}ОШИБКА подключения для DDL: {e}", "ERROR")
+                    continue
+                self._apply_ddl(client, params, preamble, waves, objects, run_id, job, prefix)
 
-            # Verify
-            for db, table in self.selected_tables:
-                if self._verify_table_exists(db, table):
-                    self._log(f"Проверка OK: `{db}`.`{table}` существует на destination")
-                else:
-                    self._log(f"Проверка FAIL: `{db}`.`{table}` НЕ найдена на destination", "ERROR")
+        return _do
+
+    def _apply_ddl(self, client, params: dict, preamble: list[str], waves: list[list[str]],
+                   objects: list[tuple[str, str]], run_id: str, job: Job, prefix: str = ""):
+        """Run the DDL waves on one destination, then check the objects exist there."""
+        total = len(preamble) + sum(len(w) for w in waves)
+        counter = {"n": 0}
+        lock = threading.Lock()
+
+        def _run(conn, stmt: str, settings: Optional[dict] = None):
+            if job.cancelled:
+                return
+            try:
+                conn.command(stmt, settings=dict(
+                    settings or {}, query_id=stage_query_id(f"chm-{run_id}", "ddl")))
+                with lock:
+                    counter["n"] += 1
+                    i = counter["n"]
+                self._log(f"{prefix}Выполнено ({i}/{total}): {stmt[:80]}...")
+            except Exception as e:
+                with lock:
+                    counter["n"] += 1
+                    i = counter["n"]
+                self._log(f"{prefix}ОШИБКА ({i}/{total}): {e}", "ERROR")
+
+        for stmt in preamble:
+            _run(client, stmt)
 
-            self._set_buttons_state(True)
+        settings = self._parse_set_settings(preamble)
+        pool = ConnectionPool(lambda: self._make_client_from_params(params))
 
-        threading.Thread(target=_do, daemon=True).start()
+        def _run_pooled(stmt: str):
+            try:
+                with pool.connection() as conn:
+                    _run(conn, stmt, settings)
+            except Exception as e:
+                self._log(f"{prefix}ОШИБКА подключения для DDL: {e}", "ERROR")
+
+        for wave_no, wave in enumerate(waves, 1):
+            job.check()
+            if len(wave) == 1:
+                _run(client, wave[0], settings)
+                continue
+
+            self._log(f"{prefix}Волна {wave_no}: {len(wave)} объектов параллельно")
+            with ThreadPoolExecutor(max_workers=min(DDL_PARALLELISM, len(wave))) as executor:
+                list(executor.map(_run_pooled, wave))
+        job.check()
+
+        # Verify
+        for db, table in objects:
+            if self._verify_table_exists(client, db, table):
+                self._log(f"{prefix}Проверка OK: `{db}`.`{table}` существует на destination")
+            else:
+                self._log(f"{prefix}Проверка FAIL: `{db}`.`{table}` НЕ найдена на destination", "ERROR")
 
-    def _verify_table_exists(self, database: str, table: str) -> bool:
+    @staticmethod
+    def _verify_table_exists(client, database: str, table: str) -> bool:
         try:
-            result = self.dest_client.query(
+            result = client.query(
                 "SELECT count() FROM system.tables WHERE database = %(db)s AND name = %(tbl)s",
                 parameters={"db": database, "tbl": table},
             ).result_rows
@@ -1049,6 +3370,270 @@ class CHMigrateApp:
         except Exception:
             return False
 
+    # ── Distributed Sources ──────────────────────────────────────────
+
+    def _engine_args(self, engine_full: str, engine: str) -> list[str]:
+        """Top-level arguments of `Engine(...)` in system.tables.engine_full, quotes stripped."""
+        m = re.match(rf"\s*{engine}\s*\(", engine_full)
+        if not m:
+            return []
+        depth, end = 1, m.end()
+        while end < len(engine_full) and depth:
+            depth += {"(": 1, ")": -1}.get(engine_full[end], 0)
+            end += 1
+        args = self._split_top_level(engine_full[m.end():end - 1])
+        return [a[1:-1] if len(a) >= 2 and a[0] == a[-1] and a[0] in "'`\"" else a for a in args]
+
+    def _distributed_info(self, client, db: str, table: str) -> Optional[dict]:
+        """Cluster, local table and sharding key of a Distributed table; None for other engines."""
+        rows = client.query(
+            "SELECT engine, engine_full FROM system.tables WHERE database = %(db)s AND name = %(tbl)s",
+            parameters={"db": db, "tbl": table},
+        ).result_rows
+        if not rows or rows[0][0] != "Distributed":
+            return None
+        args = self._engine_args(rows[0][1], "Distributed")
+        if len(args) < 3:
+            return None
+        local_db = db if not args[1] or args[1].startswith("currentDatabase") else args[1]
+        return {"cluster": args[0], "db": local_db, "table": args[2],
+                "sharding_key": args[3] if len(args) > 3 else ""}
+
+    @staticmethod
+    def _cluster_shards(client, cluster: str) -> list[tuple[int, int, list[tuple[str, int, int]]]]:
+        """[(shard_num, shard_weight, [(host, port, errors_count), ...]), ...] from system.clusters."""
+        rows = client.query(
+            "SELECT shard_num, shard_weight, host_name, port, errors_count FROM system.clusters "
+            "WHERE cluster = %(cluster)s ORDER BY shard_num, replica_num",
+            parameters={"cluster": cluster},
+        ).result_rows
+        shards: dict[int, tuple[int, list]] = {}
+        for shard_num, weight, host, port, errors in rows:
+            shards.setdefault(shard_num, (weight, []))[1].append((host, port, errors))
+        return [(num, weight, replicas) for num, (weight, replicas) in sorted(shards.items())]
+
+    @staticmethod
+    def _node_params(params: dict, host: str, port: int) -> dict:
+        """Params for a cluster node: same credentials and protocol as `params`.
+
+        system.clusters reports the native port, so it only replaces the
+        configured one when that is native as well.
+        """
+        node = dict(params, host=host)
+        if int(params.get("port", 8123)) in NATIVE_PORTS:
+            node["port"] = port
+        return node
+
+    def _shard_pools(self, params: dict, shards) -> list[tuple[int, ReplicaPool]]:
+        """A ReplicaPool per shard with replicas ordered from least to most loaded.
+
+        Load is the number of running queries (system.metrics), probed on all
+        replicas in parallel; unreachable replicas go last, ties are broken
+        by system.clusters.errors_count.
+        """
+        probes = [(num, host, self._node_params(params, host, port), errors)
+                  for num, _, replicas in shards for host, port, errors in replicas]
+
+        def _probe(probe):
+            num, host, node, errors = probe
+            try:
+                client = self._make_client_from_params(node)
+                load = int(client.command("SELECT value FROM system.metrics WHERE metric = 'Query'"))
+                return client, (0, load, errors)
+            except Exception as e:
+                self._log(f"  Реплика {host} (шард {num}) недоступна: {e}", "WARN")
+                return None, (1, 0, errors)
+
+        with ThreadPoolExecutor(max_workers=min(CLUSTER_PROBE_PARALLELISM, len(probes))) as executor:
+            results = list(executor.map(_probe, probes))
+
+        pools = []
+        for num, _, _ in shards:
+            ranked = sorted(((rank, host, node, client)
+                             for (n, host, node, _), (client, rank) in zip(probes, results) if n == num),
+                            key=lambda r: r[0])
+            initial = {host: client for _, host, _, client in ranked if client is not None}
+            pools.append((num, ReplicaPool([(host, node) for _, host, node, _ in ranked],
+                                           self._make_client_from_params, self._log, initial)))
+        return pools
+
+    @staticmethod
+    def _retarget_select(sql: str, db: str, table: str, local_db: str, local_table: str) -> Optional[str]:
+        """Point the SELECT at the local table instead of db.table; None if it is not referenced."""
+        pattern = (rf"(?:`{re.escape(db)}`|\b{re.escape(db)}\b)\."
+                   rf"(?:`{re.escape(table)}`|\b{re.escape(table)}\b)")
+        local_sql, count = re.subn(pattern, lambda _: f"`{local_db}`.`{local_table}`", sql)
+        return local_sql if count else None
+
+    def _source_shard_reads(self, client, params: dict, db: str, table: str, select_sql: str,
+                            cache: dict) -> list[tuple[int, str, ReplicaPool, str, str, str]]:
+        """Per-shard reads of a Distributed source table, bypassing the initiator node.
+
+        Returns [(shard num, label, shard pool, local db, local table, SELECT on the local table)],
+        or [] when db.table is not Distributed or the SELECT cannot be retargeted.
+        """
+        info = self._distributed_info(client, db, table)
+        if info is None:
+            return []
+        local_sql = self._retarget_select(select_sql, db, table, info["db"], info["table"])
+        if local_sql is None:
+            self._log(f"  `{db}`.`{table}`: Distributed, но таблица не найдена в SELECT — "
+                      f"чтение через initiator", "WARN")
+            return []
+        if info["cluster"] not in cache:
+            cache[info["cluster"]] = self._shard_pools(params, self._cluster_shards(client, info["cluster"]))
+        pools = cache[info["cluster"]]
+        if not pools:
+            self._log(f"  Кластер '{info['cluster']}' не найден в system.clusters, чтение через initiator", "WARN")
+            return []
+        self._log(f"  `{db}`.`{table}`: Distributed → `{info['db']}`.`{info['table']}` "
+                  f"на {len(pools)} шардах кластера '{info['cluster']}'")
+        for num, pool in pools:
+            self._log(f"    шард {num}: {', '.join(host for host, _ in pool.replicas)}")
+        return [(num, f"[шард {num}] ", pool, info["db"], info["table"], local_sql) for num, pool in pools]
+
+    # ── Distributed Destinations ─────────────────────────────────────
+
+    def _dest_shard_layout(self, target_pool: ConnectionPool, params: dict, db: str, table: str,
+                           cache: dict) -> Optional[dict]:
+        """Plan for inserting straight into the shards of a Distributed destination table.
+
+        Returns {"target", "table" (local), "key_expr", "slots", "shards": [(shard_num, ReplicaPool)]}
+        for the primary destination, or None to insert through db.table as usual.
+        The source evaluates `key_expr`: the sharding key cast to the unsigned
+        type of the same width, which is what the Distributed engine takes the
+        remainder of.
+        """
+        try:
+            with target_pool.connection() as targets:
+                client = targets[0][1]
+                info = self._distributed_info(client, db, table)
+                if info is None:
+                    return None
+                shards = self._cluster_shards(client, info["cluster"])
+                # A single-shard table may have no sharding key
+                key = info["sharding_key"] or ("0" if len(shards) == 1 else "")
+                key_type = ""
+                if key:
+                    key_type = client.query(f"DESCRIBE (SELECT {key} FROM `{db}`.`{table}`)").result_rows[0][1]
+        except Exception as e:
+            self._log(f"  Не удалось разобрать Distributed `{db}`.`{table}` на destination: {e}", "WARN")
+            return None
+
+        # NULL keys cannot be routed: Nullable(...) and LowCardinality(Nullable(...)) go through Distributed
+        base_type = re.sub(r"^LowCardinality\((.*)\)$", r"\1", key_type)
+        m = re.fullmatch(r"U?Int(8|16|32|64|128|256)", base_type)
+        slots = [i for i, (_, weight, _) in enumerate(shards) for _ in range(weight)]
+        if not slots or not m:
+            self._log(f"  `{db}`.`{table}`: Distributed на destination без кластера или целочисленного "
+                      f"не-Nullable ключа шардирования ({key_type or '—'}), вставка через Distributed", "WARN")
+            return None
+        if info["cluster"] not in cache:
+            cache[info["cluster"]] = self._shard_pools(params, shards)
+        layout = {
+            "target": "Destination",
+            "table": f"`{info['db']}`.`{info['table']}`",
+            "key_expr": f"toUInt{m.group(1)}({key})",
+            "slots": slots,
+            "shards": cache[info["cluster"]],
+        }
+        self._log(f"  `{db}`.`{table}`: вставка напрямую в {layout['table']} на {len(shards)} шардах "
+                  f"кластера '{info['cluster']}' по ключу {key}")
+        return layout
+
+    # ── Sorting-key Range Splitting ──────────────────────────────────
+
+    @staticmethod
+    def _split_top_level(expr: str) -> list[str]:
+        """Split a comma-separated expression list, ignoring commas inside brackets."""
+        parts, depth, current = [], 0, ""
+        for ch in expr:
+            if ch in "([":
+                depth += 1
+            elif ch in ")]":
+                depth -= 1
+            if ch == "," and depth == 0:
+                parts.append(current.strip())
+                current = ""
+            else:
+                current += ch
+        if current.strip():
+            parts.append(current.strip())
+        return parts
+
+    def _plan_key_ranges(self, client, db: str, table: str, select_sql: str,
+                         options: dict, read_settings: Optional[dict] = None) -> list[Optional[str]]:
+        """Split a large table copy into non-overlapping ranges of the first sorting-key column.
+
+        Boundaries are `quantiles` of the key (over SAMPLE when the table has a
+        sampling key). Returns WHERE conditions, or [None] for a single full copy.
+        """
+        splits = options["range_splits"]
+        if splits < 2 or re.search(r"\bLIMIT\b", select_sql, re.I):
+            return [None]
+        try:
+            rows = client.query(
+                "SELECT sorting_key, sampling_key, total_rows FROM system.tables "
+                "WHERE database = %(db)s AND name = %(tbl)s",
+                parameters={"db": db, "tbl": table},
+            ).result_rows
+            if not rows or not rows[0][0] or (rows[0][2] or 0) < options["range_split_min_rows"]:
+                return [None]
+            sorting_key, sampling_key, _ = rows[0]
+            key = self._split_top_level(sorting_key)[0]
+            full_name = f"`{db}`.`{table}`"
+            key_type = client.command(f"SELECT toTypeName({key}) FROM {full_name} LIMIT 1")
+            levels = ", ".join(f"{k / splits:.6f}" for k in range(1, splits))
+            sample = " SAMPLE 0.01" if sampling_key else ""
+            bounds = client.query(
+                f"SELECT arrayMap(x -> toString(CAST(x AS {key_type})), quantiles({levels})({key})) "
+                f"FROM {full_name}{sample}", settings=read_settings or None,
+            ).result_rows[0][0]
+        except Exception as e:
+            self._log(f"  Разбиение `{db}`.`{table}` по ключу недоступно: {e}", "WARN")
+            return [None]
+
+        bounds = sorted(set(bounds), key=bounds.index)
+        if not bounds:
+            return [None]
+        lits = [f"CAST({self._sql_string(b)} AS {key_type})" for b in bounds]
+        conds = [f"{key} < {lits[0]}" + (f" OR {key} IS NULL" if "Nullable" in key_type else "")]
+        conds += [f"{key} >= {lo} AND {key} < {hi}" for lo, hi in zip(lits, lits[1:])]
+        conds.append(f"{key} >= {lits[-1]}")
+        self._log(f"  `{db}`.`{table}`: {len(conds)} диапазонов по ключу {key}")
+        return conds
+
+    @staticmethod
+    def _table_sorting_key(client, db: str, table: str) -> str:
+        rows = client.query(
+            "SELECT sorting_key FROM system.tables WHERE database = %(db)s AND name = %(tbl)s",
+            parameters={"db": db, "tbl": table},
+        ).result_rows
+        return rows[0][0] if rows else ""
+
+    @staticmethod
+    def _read_order(sorting_key: str, columns: list[tuple[str, str]]) -> list[str]:
+        """Sorting key prefix a SELECT can be ordered by cheaply, [] if there is none.
+
+        Only the leading key elements that are plain columns of the SELECT
+        output count: the server reads them in primary key order without a
+        full sort. A transform, tag column or edited SELECT that drops or
+        renames the first key column leaves nothing to order by.
+        """
+        names = {name for name, _ in columns}
+        prefix = []
+        for element in CHMigrateApp._split_top_level(sorting_key):
+            match = re.fullmatch(r"`([^`]+)`|([A-Za-z_]\w*)", element)
+            if not match or (match.group(1) or match.group(2)) not in names:
+                break
+            prefix.append(match.group(1) or match.group(2))
+        return prefix
+
+    @staticmethod
+    def _unit_key(source: str, shard: int, range_cond: Optional[str]) -> str:
+        """Dedup token part of one copy unit: source, shard (0 = the table itself), key range."""
+        return dedup_token(source, shard, range_cond or "")
+
     # ── Data Migration ───────────────────────────────────────────────
 
     def _migrate_data(self):
@@ -1071,33 +3656,735 @@ class CHMigrateApp:
             )
             return
 
-        def _do():
-            self._set_buttons_state(False)
+        max_lag = self._fanout_config()["max_lag"]
+        source_name = self.source_combo.get() or "Source"
+        source_params = dict(self.source_params)
+        tag_column = self._multisource_config()["tag_column"]
+        transforms = dict(self.connections.get("transforms", {}))
+        options = self._migration_options()
+        run_id = uuid.uuid4().hex[:8]
+        profiler = StageProfiler(enabled=options["profile"])
+        object_types = {key: self._get_object_type(*key) for key in tables_sorted}
+        deferred = {key: list(v) for key, v in self.deferred_clauses.items()
+                    if key in tables_sorted} if options["defer_indexes"] else {}
+        kept_tables = set(self.kept_tables)
+        endpoints = self._run_endpoints()
+        params_by_source = {name: dict(params) for name, params in self.connections.get("sources", {}).items()}
+        params_by_source[source_name] = source_params
+        dest_params = dict(self.dest_params)
+        # Staging tables follow the DDL script, which may differ from the live tables
+        staging_ddls, staging_settings = self._staging_ddls(self.ddl_mig_text.get("1.0", tk.END))
+
+        def _do(job: Job):
+            job.on_cancel(lambda: self._kill_run_queries(run_id, endpoints))
+            self._ui_profiler = profiler if profiler.enabled else None
+            try:
+                _migrate(job)
+            finally:
+                self._ui_profiler = None
+                # A cancelled or failed run must not leave tables without their indexes and projections
+                if deferred:
+                    self._restore_deferred_clauses(deferred)
+
+        def _migrate(job: Job):
             total = len(statements)
-
-            for i, ((db, table), select_sql) in enumerate(zip(tables_sorted, statements), 1):
+            unit_ids = iter(range(1, 1 << 62))
+            python_profile: dict = {}
+            # Own connections only: the UI thread keeps querying through source_client and dest_client
+            sources = [(source_name, ConnectionPool(lambda: self._make_client_from_params(source_params)))]
+            sources += self._connect_extra_sources(source_name)
+            # Every worker gets its own set of destination connections
+            target_pool = ConnectionPool(lambda: self._connect_fanout_targets(include_primary=True))
+            if len(sources) > 1:
+                self._log(f"Консолидация из {len(sources)} источников: "
+                          + ", ".join(name for name, _ in sources))
+
+            def _run_unit(unit):
+                (name, pool, db, table, select_sql, range_cond, range_label, row_bytes, dest_table,
+                 partition_expr, shard_layout, sorting_key, shard) = unit
+                label = (f"[{name}] " if len(sources) > 1 else "") + range_label
+                throttles = [self._get_throttle(""), self._get_throttle(name)]
+                read_settings = self._read_settings(name)
+                query_id_prefix = f"chm-{run_id}-{next(unit_ids)}"
+                # Sources and shards run the same SELECT, so the token has to name the unit itself
+                unit_key = self._unit_key(name, shard, range_cond)
+                spill_bytes = options["spill_max_mb"] * 1024 * 1024 if options["spill"] else 0
+                # Partition regrouping, shard routing and spill need decoded rows
+                passthrough = (options["passthrough"] and not partition_expr and not shard_layout
+                               and not spill_bytes)
+                # cProfile/tracemalloc wrap only the first copy unit of the chosen table
+                profile_this = (options["profile_table"] == f"{db}.{table}"
+                                and python_profile.setdefault("unit", query_id_prefix) == query_id_prefix)
+                if job.cancelled:
+                    return None
                 try:
+                    with target_pool.connection() as targets:
+                        sql = select_sql
+                        if range_cond:
+                            sql = f"SELECT * FROM ({sql}) WHERE {range_cond}"
+                        spec = transforms.get(f"{db}.{table}")
+                        if spec:
+                            with pool.connection() as client:
+                                sql = self._transform_select(sql, spec, self._describe_select(client, sql))
+                        if tag_column:
+                            sql = self._tag_select(sql, tag_column, name)
+                        order_by = []
+                        if options["ordered_reads"]:
+                            with pool.connection() as client:
+                                order_by = self._read_order(sorting_key, self._describe_select(client, sql))
+                        attempts = iter(range(1, RANGE_RETRIES + 1))
+
+                        def _read():
+                            attempt = next(attempts)
+                            # Connection per attempt: a shard's ReplicaPool fails over to the next replica
+                            with pool.connection() as client:
+                                if passthrough and self._supports_passthrough(client, targets):
+                                    return self._passthrough_table(client, db, table, sql, targets, max_lag,
+                                                                   label, throttles, read_settings, row_bytes,
+                                                                   profiler, query_id_prefix, dest_table, job,
+                                                                   dedup_token(unit_key, attempt))
+                                # Ordered blocks repeat exactly, so a retry reuses their tokens and the
+                                # destination drops what the failed attempt already wrote
+                                copy_key = unit_key if order_by else dedup_token(unit_key, attempt)
+                                return self._copy_table(client, db, table, sql, targets, max_lag, label,
+                                                        throttles, read_settings, row_bytes, profiler,
+                                                        query_id_prefix, dest_table, partition_expr,
+                                                        options["partition_batch_rows"],
+                                                        options["partition_buffer_rows"], job, spill_bytes,
+                                                        shard_layout, copy_key, order_by)
+
+                        def _copy():
+                            return call_with_retry(_read, f"  {label}`{db}`.`{table}`", self._log,
+                                                   attempts=RANGE_RETRIES, job=job)
+
+                        if profile_this:
+                            python_profile["table"] = f"{db}.{table} {label}".strip()
+                            result = {}
+                            python_profile["text"] = self._run_python_profiled(
+                                lambda: result.setdefault("rows", _copy()))
+                            return result.get("rows")
+                        return _copy()
+                except JobCancelled:
+                    return None
+                except Exception as e:
+                    self._log(f"  {label}ОШИБКА миграции `{db}`.`{table}`: {e}", "ERROR")
+                    return None
+
+            watched: list[tuple[str, object, str, str]] = []
+            # source name -> cluster -> shard pools, resolved once per run
+            shard_cache: dict[str, dict] = {}
+            dest_shards: dict = {}
+            with ThreadPoolExecutor(max_workers=max(1, options["max_parallel"])) as executor:
+                for i, ((db, table), select_sql) in enumerate(zip(tables_sorted, statements), 1):
+                    job.check()
                     self._log(f"Миграция ({i}/{total}): `{db}`.`{table}`...")
-                    result = self.source_client.query(select_sql)
-
-                    if not result.result_rows:
-                        self._log(f"  Нет данных для `{db}`.`{table}`")
+                    # Copying into a table whose rows the DDL kept would duplicate them
+                    if (db, table) in kept_tables:
+                        self._log(f"  `{db}`.`{table}` сохранена на destination (ALTER по схеме), "
+                                  f"копирование пропущено", "WARN")
+                        continue
+                    staging = options["staging"] and object_types.get((db, table)) == "table"
+                    dest_table = None
+                    if staging:
+                        dest_table = self._prepare_staging(target_pool, db, table, staging_ddls.get((db, table), ""),
+                                                           staging_settings)
+                        if dest_table is None:
+                            continue
+                    partition_expr = ""
+                    if options["partition_batching"]:
+                        partition_expr = self._dest_partition_key(target_pool, db, table)
+                    shard_layout = None
+                    if options["shard_writes"] and not staging:
+                        shard_layout = self._dest_shard_layout(target_pool, dest_params, db, table, dest_shards)
+                        for _, shard_pool in (shard_layout or {}).get("shards", []):
+                            endpoints.extend(r for r in shard_pool.replicas if r not in endpoints)
+                    units = []
+                    for name, pool in sources:
+                        # (shard, label, pool, table to plan ranges on, SELECT): the table itself, or its shards
+                        reads = [(0, "", pool, db, table, select_sql)]
+                        if options["shard_reads"] and not re.search(r"\bLIMIT\b", select_sql, re.I):
+                            try:
+                                with pool.connection() as client:
+                                    shards = self._source_shard_reads(client, params_by_source[name], db, table,
+                                                                      select_sql, shard_cache.setdefault(name, {}))
+                            except Exception as e:
+                                self._log(f"  Не удалось разобрать Distributed `{db}`.`{table}`, "
+                                          f"чтение через initiator: {e}", "WARN")
+                                shards = []
+                            reads = shards or reads
+                            # Shard replicas are queried directly, so cancelling must KILL there too
+                            for _, _, shard_pool, *_ in shards:
+                                endpoints.extend(r for r in shard_pool.replicas if r not in endpoints)
+                        for shard, read_label, read_pool, plan_db, plan_table, read_sql in reads:
+                            ranges, row_bytes, sorting_key = [None], 0.0, ""
+                            try:
+                                with read_pool.connection() as client:
+                                    ranges = self._plan_key_ranges(client, plan_db, plan_table, read_sql, options,
+                                                                   self._read_settings(name))
+                                    row_bytes = self._estimate_row_bytes(client, plan_db, plan_table)
+                                    sorting_key = self._table_sorting_key(client, plan_db, plan_table)
+                            except Exception:
+                                pass  # copied as planned so far; the unit itself retries / fails over
+                            for j, cond in enumerate(ranges, 1):
+                                range_label = read_label + (f"[{j}/{len(ranges)}] " if len(ranges) > 1 else "")
+                                units.append((name, read_pool, db, table, read_sql, cond, range_label, row_bytes,
+                                              dest_table, partition_expr, shard_layout, sorting_key, shard))
+                    results = list(executor.map(_run_unit, units))
+                    # A cancelled table keeps its staging copy, the live one is not swapped
+                    job.check()
+                    if staging:
+                        if any(r is None for r in results):
+                            self._log(f"  `{db}`.`{table}` скопирована не полностью: {dest_table} оставлена, "
+                                      f"рабочая таблица не изменена", "ERROR")
+                        else:
+                            self._finish_staging(target_pool, db, table, sum(results))
+                    if partition_expr:
+                        self._log_new_parts(target_pool, db, table, run_id)
+                    if (db, table) in deferred:
+                        clauses = deferred.pop((db, table))
+                        with target_pool.connection() as targets:
+                            for name, client in targets:
+                                prefix = f"[{name}] " if len(targets) > 1 else ""
+                                self._add_deferred_clauses(client, db, table, clauses, prefix)
+                                watched.append((name, client, db, table))
+
+            self._wait_mutations(watched, job)
+            self._log("Миграция завершена")
+            if profiler.enabled:
+                self._save_profile_report(run_id, profiler, sources, target_pool,
+                                          tables_sorted, python_profile)
+
+        return _do
+
+    def _copy_table(self, source_client, db: str, table: str, select_sql: str,
+                    targets: list[tuple[str, object]], max_lag: int, label: str = "",
+                    throttles: list[Throttle] = (), read_settings: Optional[dict] = None,
+                    row_bytes: float = 0.0, profiler: Optional[StageProfiler] = None,
+                    query_id_prefix: str = "", dest_table: Optional[str] = None,
+                    partition_expr: str = "", batch_rows: int = 0, buffer_rows: int = 0,
+                    job: Optional[Job] = None, spill_bytes: int = 0,
+                    shard_layout: Optional[dict] = None, unit_key: str = "",
+                    order_by: Sequence[str] = ()) -> int:
+        """Stream SELECT result block by block into every target destination.
+
+        Each block is read from source once and handed to one DestinationWriter
+        per destination, so inserts into different destinations run in parallel.
+        Throttles hold a query slot for the whole read and meter every block.
+        Rows go to `dest_table` (e.g. a staging table) instead of db.table if given.
+        With `partition_expr` the source also computes the destination partition
+        of every row and blocks are regrouped so each insert creates one part.
+        A cancelled `job` stops the read at the next block.
+        With `spill_bytes` every destination is fed from its own on-disk
+        SpillQueue of that size, so the source query finishes as fast as the
+        source can send and the inserts catch up afterwards.
+        With `shard_layout` (see _dest_shard_layout) the source also computes
+        the sharding key and that target's rows go straight to the local
+        table on every shard through a ShardRouter.
+        `unit_key` identifies the copy unit (source, range) in the dedup tokens:
+        units of a multi-source run share the SELECT text, their blocks must not.
+        With `order_by` (columns, see _read_order) the result is sorted and
+        re-cut into blocks of about ORDERED_BLOCK_ROWS rows that end where
+        the key changes, so every attempt sends the same rows under the same
+        tokens.
+        Without it blocks differ between attempts: a failure after some rows
+        were written raises UnsafeRetry instead of allowing a retry.
+        Blocks stay in the column form the source stream yields them in and are
+        inserted column-oriented; only partition batching regroups rows and so
+        builds row tuples.
+        Returns the number of rows read from source.
+        """
+        profiler = profiler or StageProfiler(enabled=False)
+        full_name = dest_table or f"`{db}`.`{table}`"
+        read_rows = 0
+        writers: list = []
+        settings = dict(read_settings or {})
+        if query_id_prefix:
+            settings["query_id"] = stage_query_id(query_id_prefix, "read")
+        if order_by:
+            # Server blocks of that size go through fixed_blocks without being copied
+            settings.setdefault("max_block_size", ORDERED_BLOCK_ROWS)
+        # Computed columns ride at the end of every row: shard key, then partition
+        computed = []
+        if shard_layout:
+            computed.append(f"{shard_layout['key_expr']} AS {SHARD_COLUMN}")
+        if partition_expr:
+            computed.append(f"{partition_expr} AS {PARTITION_COLUMN}")
+        if computed:
+            select_sql = f"SELECT *, {', '.join(computed)} FROM ({select_sql})"
+        if order_by:
+            order_list = ", ".join(f"`{name}`" for name in order_by)
+            select_sql = f"SELECT * FROM ({select_sql}) ORDER BY {order_list}"
+        columnar = not partition_expr
+        spill_dir = ""
+        if spill_bytes:
+            spill_dir = os.path.join(SPILL_DIR, f"{query_id_prefix or 'chm'}-{uuid.uuid4().hex[:6]}")
+
+        def _spill(key: str) -> Optional[SpillQueue]:
+            return SpillQueue(os.path.join(spill_dir, key), spill_bytes) if spill_dir else None
+
+        if not row_bytes and any(throttle.bytes.rate > 0 for throttle in throttles):
+            self._log(f"  {label}`{db}`.`{table}`: размер строки неизвестен (Distributed, представление или "
+                      f"пустая таблица), лимит МБ/с к этому копированию не применяется", "WARN")
+        read_start = time.monotonic()
+        failure: Optional[Exception] = None
+        # Shard connections outlive the source stream: they are released after the writers drain,
+        # and only a failed shard writer (not a source error) demotes its replica
+        shard_connections: list[tuple[ReplicaPool, str, object, DestinationWriter]] = []
+        with ExitStack() as stack:
+            with profiler.stage("throttle.query_slot"):
+                for throttle in throttles:
+                    stack.enter_context(throttle.query_slot())
+            try:
+                with profiler.stage("source.open"):
+                    stream = stack.enter_context(
+                        source_client.query_column_block_stream(select_sql, settings=settings or None))
+                col_names = stream.source.column_names[:len(stream.source.column_names) - len(computed)]
+                blocks = stream
+                if order_by:
+                    blocks = fixed_blocks(stream, ORDERED_BLOCK_ROWS, [col_names.index(c) for c in order_by])
+                token_prefix = dedup_token(full_name, unit_key, select_sql)
+                router = None
+                for i, (name, client) in enumerate(targets):
+                    if shard_layout and name == shard_layout["target"]:
+                        # Registered first, so a failed acquire still closes the shard writers made so far
+                        shard_writers = []
+                        router = ShardRouter(name, shard_writers, shard_layout["slots"], columnar)
+                        writers.append(router)
+                        for shard_num, pool in shard_layout["shards"]:
+                            host, conn = pool.acquire()
+                            shard_writers.append(DestinationWriter(
+                                f"{name}/шард {shard_num}", conn,
+                                shard_layout["table"], col_names, max_lag, self._log,
+                                dedup_token(token_prefix, shard_num), profiler, query_id_prefix, job,
+                                _spill(f"{i}-{shard_num}"), columnar))
+                            shard_connections.append((pool, host, conn, shard_writers[-1]))
+                    else:
+                        writers.append(DestinationWriter(name, client, full_name, col_names, max_lag, self._log,
+                                                         token_prefix, profiler, query_id_prefix, job,
+                                                         _spill(str(i)), columnar))
+
+                def _emit(block):
+                    plain = block
+                    if router and len(writers) > 1:
+                        plain = block[:-1] if columnar else [row[:-1] for row in block]
+                    for writer in writers:
+                        writer.put(block if writer is router else plain)
+
+                batcher = PartitionBatcher(_emit, batch_rows, buffer_rows) if partition_expr else None
+                while True:
+                    if job is not None:
+                        job.check()
+                    with profiler.stage("source.fetch+decode"):
+                        columns = next(blocks, None)
+                    if columns is None:
+                        break
+                    if batcher:
+                        with profiler.stage("rows.build"):
+                            block = list(zip(*columns[:-1]))
+                        block_rows = len(block)
+                    else:
+                        block = list(columns)
+                        block_rows = len(block[0]) if block else 0
+                    if not block_rows:
                         continue
+                    read_rows += block_rows
+                    with profiler.stage("throttle.wait"):
+                        for throttle in throttles:
+                            throttle.consume(block_rows, block_rows * row_bytes)
+                    if batcher:
+                        with profiler.stage("partition.bucket"):
+                            batcher.add(block, columns[-1])
+                    else:
+                        _emit(block)
+                if batcher:
+                    batcher.finish()
+                # Release the source query and throttle slots before waiting for the inserts
+                stack.close()
+                if spill_dir and read_rows:
+                    self._log(f"  {label}{full_name}: source прочитан за {time.monotonic() - read_start:.1f} с, "
+                              f"вставка продолжается из spill")
+            except JobCancelled:
+                raise
+            except Exception as e:
+                failure = e
+                raise
+            finally:
+                for writer in writers:
+                    writer.close()
+                for pool, host, conn, writer in shard_connections:
+                    pool.release(host, conn, failed=writer.error is not None)
+                if spill_dir:
+                    shutil.rmtree(spill_dir, ignore_errors=True)
+                written = sum(writer.rows for writer in writers)
+                if failure is not None and not order_by and written:
+                    raise UnsafeRetry(f"чтение прервано после записи {written} строк без детерминированного "
+                                      f"порядка, повтор дал бы потери или дубликаты: {failure}") from failure
+
+        if not read_rows:
+            self._log(f"  {label}Нет данных для {full_name}")
+            return 0
+        for writer in writers:
+            prefix = label + (f"[{writer.name}] " if len(writers) > 1 else "")
+            written_to = full_name
+            notes = f", вставок по партициям: {writer.blocks}" if partition_expr else ""
+            if isinstance(writer, ShardRouter):
+                written_to = shard_layout["table"]
+                notes += ", по шардам: " + ", ".join(
+                    f"{num}: {w.rows}" for (num, _), w in zip(shard_layout["shards"], writer.writers))
+            if writer.error is None:
+                self._log(f"  {prefix}Мигрировано {writer.rows} строк в {written_to}{notes}")
+            else:
+                self._log(f"  {prefix}Прервано после {writer.rows}/{read_rows} строк в {written_to}: "
+                          f"{writer.error}", "ERROR")
+        return read_rows
 
-                    col_names = result.column_names
-                    self.dest_client.insert(
-                        table=f"`{db}`.`{table}`",
-                        data=result.result_rows,
-                        column_names=col_names,
+    @staticmethod
+    def _supports_passthrough(source_client, targets: list[tuple[str, object]]) -> bool:
+        """Raw byte streams exist only in the HTTP client, on both ends."""
+        return hasattr(source_client, "raw_stream") and all(hasattr(c, "raw_insert") for _, c in targets)
+
+    def _passthrough_table(self, source_client, db: str, table: str, select_sql: str,
+                           targets: list[tuple[str, object]], max_lag: int, label: str = "",
+                           throttles: list[Throttle] = (), read_settings: Optional[dict] = None,
+                           row_bytes: float = 0.0, profiler: Optional[StageProfiler] = None,
+                           query_id_prefix: str = "", dest_table: Optional[str] = None,
+                           job: Optional[Job] = None, unit_key: str = "") -> int:
+        """Copy SELECT result as undecoded PASSTHROUGH_FORMAT bytes into every target.
+
+        The source response body is read in PASSTHROUGH_CHUNK_BYTES chunks and the
+        same chunk objects are handed to one PassthroughWriter per destination, so
+        the client neither decodes values nor copies data. Throttles meter bytes;
+        rows/s is estimated from `row_bytes`. Returns the number of rows written,
+        as reported by the destination servers.
+        The newest chunk is held back until the next one arrives, so an error the
+        source appends to the body after status 200 (see stream_error) never
+        reaches the INSERTs: they are aborted instead. The server may have written
+        blocks of an aborted INSERT, and a rerun cannot tell which, so once any
+        bytes went out a failure raises UnsafeRetry. Otherwise the caller may
+        retry, with a new `unit_key` per attempt.
+        """
+        profiler = profiler or StageProfiler(enabled=False)
+        full_name = dest_table or f"`{db}`.`{table}`"
+        settings = dict(read_settings or {})
+        if query_id_prefix:
+            settings["query_id"] = stage_query_id(query_id_prefix, "read")
+        token = dedup_token(full_name, unit_key, select_sql)
+        read_bytes = 0
+        writers = [PassthroughWriter(name, client, full_name, max_lag, self._log, token, profiler,
+                                     query_id_prefix, job) for name, client in targets]
+        failure: Optional[Exception] = None
+        try:
+            with ExitStack() as stack:
+                with profiler.stage("throttle.query_slot"):
+                    for throttle in throttles:
+                        stack.enter_context(throttle.query_slot())
+                with profiler.stage("source.open"):
+                    response = source_client.raw_stream(select_sql, settings=settings or None,
+                                                        fmt=PASSTHROUGH_FORMAT)
+                stack.callback(response.close)
+                exception_tag = response.headers.get(EXCEPTION_TAG_HEADER)
+                chunks = response.stream(PASSTHROUGH_CHUNK_BYTES)
+                held, tail = None, b""
+                while True:
+                    if job is not None:
+                        job.check()
+                    with profiler.stage("source.fetch"):
+                        chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    read_bytes += len(chunk)
+                    with profiler.stage("throttle.wait"):
+                        for throttle in throttles:
+                            throttle.consume(len(chunk) / row_bytes if row_bytes else 0, len(chunk))
+                    if held is not None:
+                        for writer in writers:
+                            writer.put(held)
+                        tail = held[-PASSTHROUGH_TAIL_BYTES:]
+                    held = chunk
+                error = stream_error(tail + (held or b""), exception_tag)
+                if error:
+                    raise RuntimeError(f"source прервал ответ ошибкой: {error}")
+                if held is not None:
+                    for writer in writers:
+                        writer.put(held)
+        except Exception as e:
+            failure = e
+            raise
+        finally:
+            for writer in writers:
+                writer.close(abort=failure)
+            sent = max((writer.bytes for writer in writers), default=0)
+            if failure is not None and not isinstance(failure, JobCancelled) and sent:
+                raise UnsafeRetry(f"ошибка после отправки {sent / 1024 / 1024:.1f} МБ во вставку, повтор "
+                                  f"дал бы потери или дубликаты: {failure}") from failure
+
+        if not read_bytes:
+            self._log(f"  {label}Нет данных для {full_name}")
+            return 0
+        for writer in writers:
+            prefix = label + (f"[{writer.name}] " if len(writers) > 1 else "")
+            mb = f"{writer.bytes / 1024 / 1024:.1f} МБ {PASSTHROUGH_FORMAT}"
+            if writer.error is None:
+                self._log(f"  {prefix}Мигрировано {writer.rows} строк в {full_name} ({mb}, без декодирования)")
+            else:
+                self._log(f"  {prefix}Прервано после {mb} в {full_name}: {writer.error}", "ERROR")
+        return max(writer.rows for writer in writers)
+
+    # ── Partition-aligned Inserts ────────────────────────────────────
+
+    def _dest_partition_key(self, target_pool: ConnectionPool, db: str, table: str) -> str:
+        """Partition expression of the destination table ('' if unpartitioned or unknown)."""
+        try:
+            with target_pool.connection() as targets:
+                key = targets[0][1].command(
+                    "SELECT partition_key FROM system.tables WHERE database = %(db)s AND name = %(tbl)s",
+                    parameters={"db": db, "tbl": table},
+                )
+        except Exception as e:
+            self._log(f"  Не удалось прочитать partition_key `{db}`.`{table}`: {e}", "WARN")
+            return ""
+        key = key.strip() if isinstance(key, str) else ""
+        return "" if key in ("", "tuple()") else key
+
+    def _log_new_parts(self, target_pool: ConnectionPool, db: str, table: str, run_id: str):
+        """Report parts created by this run's inserts from system.part_log, if it is enabled."""
+        with target_pool.connection() as targets:
+            for name, client in targets:
+                prefix = f"[{name}] " if len(targets) > 1 else ""
+                try:
+                    client.command("SYSTEM FLUSH LOGS")
+                except Exception:
+                    pass
+                try:
+                    parts = client.command(
+                        "SELECT count() FROM system.part_log WHERE event_type = 'NewPart' "
+                        "AND event_date >= yesterday() AND database = %(db)s "
+                        "AND table IN %(tables)s AND query_id LIKE %(prefix)s",
+                        parameters={"db": db, "tables": (table, table + STAGING_SUFFIX),
+                                    "prefix": f"chm-{run_id}-%"},
                     )
-                    self._log(f"  Мигрировано {len(result.result_rows)} строк в `{db}`.`{table}`")
+                    self._log(f"  {prefix}`{db}`.`{table}`: создано частей {parts}")
+                except Exception:
+                    pass  # part_log is not configured on this server
+
+    # ── Staging & Exchange ───────────────────────────────────────────
+
+    @classmethod
+    def _staging_ddls(cls, ddl_text: str) -> tuple[dict[tuple[str, str], str], dict]:
+        """CREATE TABLE statements of a DDL script, minus the table name, by (db, table).
+
+        Also returns the script's SET settings, which the statements may need.
+        """
+        statements = [re.sub(r"^(?:\s*--[^\n]*\n)+", "", s.strip())
+                      for s in ddl_text.split(";") if s.strip()]
+        ident = r"(?:`[^`]+`|[\w$]+)(?:\s*\.\s*(?:`[^`]+`|[\w$]+))?"
+        creates = {}
+        for stmt in statements:
+            m = re.match(rf"\s*CREATE\s+(?:OR\s+REPLACE\s+)?TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?({ident})",
+                         stmt, re.I)
+            if m:
+                creates[cls._parse_object_name(m.group(1), "")] = stmt[m.end():]
+        return creates, cls._parse_set_settings(statements)
+
+    def _prepare_staging(self, target_pool: ConnectionPool, db: str, table: str,
+                         ddl: str = "", settings: Optional[dict] = None) -> Optional[str]:
+        """Create an empty `<table>__staging` on every destination.
+
+        `ddl` is the table's CREATE statement from the DDL script without its
+        name (see _staging_ddls): the live table was only created IF NOT EXISTS,
+        so a changed schema reaches the destination through the swap. Without
+        it the staging table is a clone of the live one.
+        MVs of the live table are not triggered by inserts into the staging table.
+        """
+        staging = f"`{db}`.`{table}{STAGING_SUFFIX}`"
+        create = f"CREATE OR REPLACE TABLE {staging}" + (ddl if ddl else f" AS `{db}`.`{table}`")
+        try:
+            with target_pool.connection() as targets:
+                for _, client in targets:
+                    client.command(create, settings=settings or None)
+        except Exception as e:
+            self._log(f"  Не удалось создать {staging}: {e}", "ERROR")
+            return None
+        self._log(f"  Загрузка в {staging}")
+        return staging
+
+    def _finish_staging(self, target_pool: ConnectionPool, db: str, table: str, expected_rows: int):
+        """Verify the staging row count and swap it with the live table on every destination."""
+        live = f"`{db}`.`{table}`"
+        staging = f"`{db}`.`{table}{STAGING_SUFFIX}`"
+        with target_pool.connection() as targets:
+            for name, client in targets:
+                prefix = f"[{name}] " if len(targets) > 1 else ""
+                try:
+                    count = int(client.command(f"SELECT count() FROM {staging}"))
+                    if count != expected_rows:
+                        self._log(f"  {prefix}{staging}: {count} строк вместо {expected_rows}, "
+                                  f"обмен отменён", "ERROR")
+                        continue
+                    # After the swap the staging name holds the previous data
+                    previous = staging
+                    try:
+                        client.command(f"EXCHANGE TABLES {staging} AND {live}")
+                    except Exception:
+                        # EXCHANGE needs an Atomic database; fall back to two renames
+                        previous = f"`{db}`.`{table}__old`"
+                        client.command(f"RENAME TABLE {live} TO {previous}, {staging} TO {live}")
+                    client.command(f"DROP TABLE IF EXISTS {previous}")
+                    self._log(f"  {prefix}{live} заменена загруженной копией ({count} строк)")
                 except Exception as e:
-                    self._log(f"  ОШИБКА миграции `{db}`.`{table}`: {e}", "ERROR")
+                    self._log(f"  {prefix}ОШИБКА обмена {staging} -> {live}: {e}", "ERROR")
 
-            self._log("Миграция завершена")
-            self._set_buttons_state(True)
+    # ── Profiling ────────────────────────────────────────────────────
 
-        threading.Thread(target=_do, daemon=True).start()
+    @staticmethod
+    def _run_python_profiled(fn) -> str:
+        """Run fn under cProfile (calling thread) and tracemalloc (all threads)."""
+        profile = cProfile.Profile()
+        tracemalloc.start()
+        profile.enable()
+        try:
+            fn()
+        finally:
+            profile.disable()
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        out = io.StringIO()
+        pstats.Stats(profile, stream=out).sort_stats("cumulative").print_stats(30)
+        out.write(f"\ntracemalloc: пик {peak / 1024 / 1024:.1f} МБ, топ аллокаций:\n")
+        for stat in snapshot.statistics("lineno")[:15]:
+            out.write(f"  {stat}\n")
+        return out.getvalue()
+
+    @staticmethod
+    def _query_log_stats(client, run_id: str) -> list[str]:
+        """Server-side totals of this run's queries (by query_id prefix) from system.query_log."""
+        try:
+            client.command("SYSTEM FLUSH LOGS")
+        except Exception:
+            pass  # needs SYSTEM FLUSH privilege; logs are flushed periodically anyway
+        rows = client.query(
+            f"SELECT {QUERY_STAGE_SQL} AS kind, count(), sum(query_duration_ms), "
+            "sum(read_rows), sum(read_bytes), sum(written_rows), sum(written_bytes), max(memory_usage) "
+            "FROM system.query_log WHERE type = 'QueryFinish' AND event_date >= yesterday() "
+            "AND query_id LIKE %(prefix)s GROUP BY kind ORDER BY kind",
+            parameters={"prefix": f"chm-{run_id}-%"},
+        ).result_rows
+        return [
+            f"  {kind}: {cnt} запросов, {ms / 1000:.3f} с, прочитано {rr} строк / {rb / 1048576:.1f} МБ, "
+            f"записано {wr} строк / {wb / 1048576:.1f} МБ, пик памяти {mem / 1048576:.1f} МБ"
+            for kind, cnt, ms, rr, rb, wr, wb, mem in rows
+        ] or ["  нет записей"]
+
+    def _save_profile_report(self, run_id: str, profiler: StageProfiler, sources, target_pool,
+                             tables: list[tuple[str, str]], python_profile: dict):
+        lines = [f"Профиль миграции {datetime.now():%Y-%m-%d %H:%M:%S}, run {run_id}",
+                 "Таблицы: " + ", ".join(f"{db}.{t}" for db, t in tables), "",
+                 "Клиент, стадии:", profiler.report(), ""]
+        endpoints = [(f"source [{name}]", pool) for name, pool in sources]
+        for label, pool in endpoints:
+            lines.append(f"Сервер {label}, system.query_log:")
+            try:
+                with pool.connection() as client:
+                    lines += self._query_log_stats(client, run_id)
+            except Exception as e:
+                lines.append(f"  недоступно: {e}")
+        try:
+            with target_pool.connection() as targets:
+                for name, client in targets:
+                    lines.append(f"Сервер destination [{name}], system.query_log:")
+                    try:
+                        lines += self._query_log_stats(client, run_id)
+                    except Exception as e:
+                        lines.append(f"  недоступно: {e}")
+        except Exception as e:
+            lines.append(f"Destination недоступен: {e}")
+        if python_profile.get("text"):
+            lines += ["", f"cProfile / tracemalloc: {python_profile['table']}", python_profile["text"]]
+
+        os.makedirs(PROFILES_DIR, exist_ok=True)
+        path = os.path.join(PROFILES_DIR, f"profile_{datetime.now():%Y%m%d_%H%M%S}_{run_id}.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        self._log(f"Отчёт профилирования сохранён: {path}")
+
+    # ── Background Jobs ──────────────────────────────────────────────
+
+    def _submit_job(self, name: str, prepare):
+        """Queue a job. `prepare` runs on the UI thread when the job starts,
+        snapshots widget state and returns the worker function(job), or None
+        if there is nothing to do.
+        """
+        def _run(job: Job):
+            work = self._call_on_ui(prepare)
+            if work is not None:
+                work(job)
+
+        self.jobs.submit(name, _run, timeout=self._migration_options()["job_timeout"] * 60)
+
+    def _call_on_ui(self, fn):
+        """Run fn() on the Tk thread and wait for its result."""
+        done = threading.Event()
+        result: dict = {}
+
+        def _run():
+            try:
+                result["value"] = fn()
+            except Exception as e:
+                result["error"] = e
+            finally:
+                done.set()
+
+        self.root.after(0, _run)
+        done.wait()
+        if "error" in result:
+            raise result["error"]
+        return result.get("value")
+
+    def _on_job_change(self, job: Job, state: str):
+        level = {"failed": "ERROR", "cancelled": "WARN", "timeout": "WARN"}.get(state, "INFO")
+        error = f": {job.error}" if state == "failed" else ""
+        self._log(f"Задача «{job.name}»: {JOB_STATES[state]}{error}", level)
+
+        active = self.jobs.active()
+        running = [j.name for j in active if j.state == "running"]
+        queued = len(active) - len(running)
+        status = [f"Выполняется: {running[0]}"] if running else []
+        if queued:
+            status.append(f"в очереди: {queued}")
+        self.lbl_jobs.config(text=", ".join(status))
+        self.btn_cancel.config(state=tk.NORMAL if active else tk.DISABLED)
+
+    def _cancel_jobs(self):
+        self._log("Отмена задач...", "WARN")
+        self.jobs.cancel_all()
+
+    def _run_endpoints(self, sources: bool = True, destinations: bool = True) -> list[tuple[str, dict]]:
+        """(name, params) of every server a run may query, for KILL QUERY."""
+        endpoints = []
+        if sources:
+            source_name = self.source_combo.get() or "Source"
+            endpoints.append((source_name, dict(self.source_params)))
+            known = self.connections.get("sources", {})
+            endpoints += [(name, dict(known[name])) for name in self._multisource_config()["sources"]
+                          if name != source_name and name in known]
+        if destinations:
+            endpoints.append(("Destination", dict(self.dest_params)))
+            known = self.connections.get("destinations", {})
+            endpoints += [(name, dict(known[name])) for name in self._fanout_config()["targets"]
+                          if name in known]
+        return endpoints
+
+    def _kill_run_queries(self, run_id: str, endpoints: list[tuple[str, dict]]):
+        """KILL every query of the run; fresh connections, the pipeline's ones are busy."""
+        for name, params in endpoints:
+            try:
+                client = self._make_client_from_params(params)
+                client.command(f"KILL QUERY WHERE query_id LIKE 'chm-{run_id}-%' ASYNC")
+                self._log(f"[{name}] KILL QUERY для chm-{run_id}", "WARN")
+            except Exception as e:
+                self._log(f"[{name}] Не удалось выполнить KILL QUERY: {e}", "ERROR")
 
     # ── UI Helpers ───────────────────────────────────────────────────
 
@@ -1106,10 +4393,13 @@ class CHMigrateApp:
         line = f"[{ts}] {level}: {message}\n"
 
         def _append():
+            start = time.perf_counter()
             self.log_text.config(state=tk.NORMAL)
             self.log_text.insert(tk.END, line)
             self.log_text.see(tk.END)
             self.log_text.config(state=tk.DISABLED)
+            if self._ui_profiler:
+                self._ui_profiler.add("ui.log_callback", time.perf_counter() - start)
 
         self.root.after(0, _append)
 
@@ -1120,16 +4410,6 @@ class CHMigrateApp:
             self.root.clipboard_append(text)
             self._log("Скопировано в буфер обмена")
 
-    def _set_buttons_state(self, enabled: bool):
-        state = tk.NORMAL if enabled else tk.DISABLED
-
-        def _do():
-            self.btn_gen_ddl.config(state=state)
-            self.btn_create_ddl.config(state=state)
-            self.btn_migrate.config(state=state)
-
-        self.root.after(0, _do)
-
 
 def main():
     load_dotenv()
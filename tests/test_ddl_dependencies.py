@@ -0,0 +1,43 @@
+from types import SimpleNamespace
+
+from ch_migrate import CHMigrateApp
+
+
+def test_parse_references_of_materialized_view():
+    ddl = ("CREATE MATERIALIZED VIEW db.mv TO `stats`.`daily` AS SELECT d, count() AS c "
+           "FROM db.events AS e LEFT JOIN users ON e.uid = users.id GROUP BY d")
+    assert CHMigrateApp._parse_ddl_references("db", ddl) == {
+        ("stats", "daily"), ("db", "events"), ("db", "users")}
+
+
+def test_parse_references_of_dictionary_source():
+    ddl = ("CREATE DICTIONARY db.d (id UInt64, name String) PRIMARY KEY id "
+           "SOURCE(CLICKHOUSE(TABLE 'users' DB 'crm')) LIFETIME(300) LAYOUT(HASHED())")
+    assert CHMigrateApp._parse_ddl_references("db", ddl) == {("crm", "users")}
+
+
+def test_dependency_graph_and_waves():
+    rows = [
+        ("db", "events", "MergeTree", ["db"], ["mv"], "CREATE TABLE db.events (d Date) ENGINE = MergeTree"),
+        ("db", "daily", "MergeTree", [], [], "CREATE TABLE db.daily (d Date, c UInt64) ENGINE = MergeTree"),
+        ("db", "mv", "MaterializedView", [], [],
+         "CREATE MATERIALIZED VIEW db.mv TO db.daily AS SELECT d, count() AS c FROM db.events GROUP BY d"),
+        ("db", "v", "View", [], [], "CREATE VIEW db.v AS SELECT * FROM db.daily"),
+    ]
+    objects = {(db, name) for db, name, *_ in rows}
+    app = SimpleNamespace(_parse_ddl_references=CHMigrateApp._parse_ddl_references)
+    deps = CHMigrateApp._load_dependency_graph(app, objects, rows)
+    assert deps[("db", "mv")] == {("db", "events"), ("db", "daily")}
+    assert CHMigrateApp._topological_waves(deps) == [
+        [("db", "daily"), ("db", "events")],
+        [("db", "mv"), ("db", "v")],
+    ]
+
+
+def test_waves_put_cycles_and_their_dependents_last():
+    deps = {("db", "a"): {("db", "b")}, ("db", "b"): {("db", "a")},
+            ("db", "c"): {("db", "a")}, ("db", "t"): set()}
+    assert CHMigrateApp._topological_waves(deps) == [
+        [("db", "t")],
+        [("db", "a"), ("db", "b"), ("db", "c")],
+    ]
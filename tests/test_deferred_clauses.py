@@ -0,0 +1,25 @@
+from types import SimpleNamespace
+
+from ch_migrate import CHMigrateApp
+
+
+class RecordingClient:
+    def __init__(self):
+        self.commands = []
+
+    def command(self, sql, settings=None):
+        self.commands.append(sql)
+
+
+def test_add_deferred_clauses_keeps_backticked_names():
+    app = SimpleNamespace(_log=lambda *args: None)
+    client = RecordingClient()
+    clauses = ["INDEX `by name` name TYPE bloom_filter GRANULARITY 1",
+               "PROJECTION totals (SELECT id, sum(v) GROUP BY id)"]
+    CHMigrateApp._add_deferred_clauses(app, client, "db", "t", clauses)
+    assert client.commands == [
+        "ALTER TABLE `db`.`t` ADD INDEX `by name` name TYPE bloom_filter GRANULARITY 1",
+        "ALTER TABLE `db`.`t` MATERIALIZE INDEX `by name`",
+        "ALTER TABLE `db`.`t` ADD PROJECTION totals (SELECT id, sum(v) GROUP BY id)",
+        "ALTER TABLE `db`.`t` MATERIALIZE PROJECTION totals",
+    ]
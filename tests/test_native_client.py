@@ -0,0 +1,17 @@
+from ch_migrate import NativeClient
+
+
+class FakeDriver:
+    def __init__(self):
+        self.queries = []
+
+    def execute(self, query, params=None, settings=None, query_id=None, **kwargs):
+        self.queries.append(query)
+        return [("24.8.4.13",)]
+
+
+def test_server_version_is_read_on_connect():
+    driver = FakeDriver()
+    client = NativeClient(driver)
+    assert client.server_version == "24.8.4.13"
+    assert driver.queries == ["SELECT version()"]
@@ -0,0 +1,54 @@
+import random
+
+from ch_migrate import CHMigrateApp, fixed_blocks
+
+
+def test_fixed_blocks_ignore_source_boundaries():
+    rows = list(range(10))
+    one = [[rows[:4], [str(r) for r in rows[:4]]], [rows[4:], [str(r) for r in rows[4:]]]]
+    other = [[rows[:1], ["0"]], [[], []], [rows[1:9], [str(r) for r in rows[1:9]]], [rows[9:], ["9"]]]
+    assert list(fixed_blocks(iter(one), 3)) == list(fixed_blocks(iter(other), 3))
+    assert [block[0] for block in fixed_blocks(iter(one), 3)] == [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]
+
+
+def test_fixed_blocks_cut_only_where_the_key_changes():
+    ids = [1, 1, 2, 2, 2, 3, 4, 4]
+    one = [[ids, list("abcdefgh")]]
+    # Same rows, equal keys in another order and other server block boundaries
+    other = [[ids[:3], list("bae")], [ids[3:], list("dcfhg")]]
+    blocks = list(fixed_blocks(iter(one), 3, [0]))
+    assert [block[0] for block in blocks] == [[1, 1, 2, 2, 2], [3, 4, 4]]
+    assert [sorted(block[1]) for block in fixed_blocks(iter(other), 3, [0])] == \
+        [sorted(block[1]) for block in blocks]
+
+
+def test_read_order_uses_selected_sorting_key_prefix():
+    columns = [("id", "UInt64"), ("ts", "DateTime"), ("name", "String")]
+    assert CHMigrateApp._read_order("id, ts", columns) == ["id", "ts"]
+    assert CHMigrateApp._read_order("`id`, toDate(ts), name", columns) == ["id"]
+
+
+def test_read_order_empty_without_first_key_column():
+    columns = [("user_id", "UInt64"), ("name", "String")]
+    assert CHMigrateApp._read_order("id, name", columns) == []
+    assert CHMigrateApp._read_order("", columns) == []
+
+
+def test_fixed_blocks_independent_of_server_blocks():
+    rng = random.Random(7)
+    ids = sorted(rng.randrange(40) for _ in range(300))
+    whole = [[ids, list(range(300))]]
+    for key in ((), (0,)):
+        expected = [block[0] for block in fixed_blocks(iter(whole), 16, key)]
+        for _ in range(20):
+            cuts = sorted(rng.sample(range(1, 300), 12))
+            split = [[ids[a:b], list(range(a, b))] for a, b in zip([0] + cuts, cuts + [300])]
+            assert [list(block[0]) for block in fixed_blocks(iter(split), 16, key)] == expected
+
+
+def test_fixed_blocks_pass_matching_blocks_through():
+    first, second = [list(range(4)), list("abcd")], [list(range(4, 8)), list("efgh")]
+    assert [block is src for block, src in zip(fixed_blocks(iter([first, second]), 4), [first, second])] == \
+        [True, True]
+    keyed = list(fixed_blocks(iter([first, second]), 4, [0]))
+    assert keyed[0] is first and keyed[1] is second
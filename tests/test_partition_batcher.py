@@ -0,0 +1,29 @@
+from ch_migrate import PartitionBatcher
+
+
+def test_flushes_full_partition_buckets():
+    emitted = []
+    batcher = PartitionBatcher(emitted.append, batch_rows=2, buffer_rows=100)
+    batcher.add(["a1", "b1", "a2", "b2", "a3"], ["a", "b", "a", "b", "a"])
+    assert emitted == [["a1", "a2"], ["b1", "b2"]]
+    batcher.finish()
+    assert emitted[-1] == ["a3"]
+
+
+def test_evicts_largest_bucket_over_buffer():
+    emitted = []
+    batcher = PartitionBatcher(emitted.append, batch_rows=4, buffer_rows=5)
+    batcher.add(["a1", "b1", "a2", "c1", "b2", "a3"], ["a", "b", "a", "c", "b", "a"])
+    assert emitted == [["a1", "a2", "a3"]]
+    batcher.finish()
+    assert sorted(emitted[1:]) == [["b1", "b2"], ["c1"]]
+
+
+def test_every_emitted_block_has_one_partition():
+    emitted = []
+    batcher = PartitionBatcher(emitted.append, batch_rows=3, buffer_rows=5)
+    rows = [(i, i % 4) for i in range(50)]
+    batcher.add(rows, [p for _, p in rows])
+    batcher.finish()
+    assert all(len({p for _, p in block}) == 1 for block in emitted)
+    assert sorted(row for block in emitted for row in block) == rows
@@ -0,0 +1,80 @@
+from types import SimpleNamespace
+
+import pytest
+
+from ch_migrate import CHMigrateApp, UnsafeRetry, stream_error
+
+ERROR = b"Code: 241. DB::Exception: Memory limit (total) exceeded. (MEMORY_LIMIT_EXCEEDED)\n"
+
+
+class FakeResponse:
+    def __init__(self, chunks, headers=None):
+        self.chunks = chunks
+        self.headers = headers or {}
+
+    def stream(self, size):
+        return iter(self.chunks)
+
+    def close(self):
+        pass
+
+
+class FakeSource:
+    def __init__(self, chunks, headers=None):
+        self.response = FakeResponse(chunks, headers)
+
+    def raw_stream(self, query, settings=None, fmt=None):
+        return self.response
+
+
+class FakeDestination:
+    def __init__(self):
+        self.body = None
+
+    def raw_insert(self, table, column_names=None, insert_block=None, settings=None, fmt=None):
+        self.body = b"".join(insert_block)
+        return SimpleNamespace(written_rows=len(self.body))
+
+
+def _passthrough(chunks, headers=None):
+    app = CHMigrateApp.__new__(CHMigrateApp)
+    app._log = lambda *args, **kwargs: None
+    destination = FakeDestination()
+    rows = app._passthrough_table(FakeSource(chunks, headers), "db", "t", "SELECT 1",
+                                  [("Destination", destination)], 4)
+    return rows, destination
+
+
+def test_stream_error_plain_and_tagged():
+    assert stream_error(b"\x00\x01native" + ERROR).startswith("Code: 241. DB::Exception")
+    assert stream_error(b"\x00\x01native") is None
+    tagged = b"\x00\x01__exception__\r\nabc123\r\nCode: 241. DB::Exception: boom\n35 abc123\r\n__exception__\r\n"
+    assert "DB::Exception: boom" in stream_error(tagged, "abc123")
+    assert stream_error(b"Code: 241. DB::Exception: in data", "abc123") is None
+
+
+def test_clean_stream_is_forwarded_whole():
+    rows, destination = _passthrough([b"aaa", b"bbb", b"cc"])
+    assert destination.body == b"aaabbbcc"
+    assert rows == 8
+
+
+def test_error_before_anything_was_sent_is_retryable():
+    with pytest.raises(RuntimeError, match="MEMORY_LIMIT_EXCEEDED") as raised:
+        _passthrough([b"data" + ERROR])
+    assert not isinstance(raised.value, UnsafeRetry)
+
+
+def test_error_after_data_was_sent_aborts_and_is_not_retried():
+    app = CHMigrateApp.__new__(CHMigrateApp)
+    app._log = lambda *args, **kwargs: None
+    received = []
+
+    def raw_insert(table, insert_block=None, **kwargs):
+        received.extend(insert_block)
+
+    destination = SimpleNamespace(raw_insert=raw_insert)
+    with pytest.raises(UnsafeRetry):
+        app._passthrough_table(FakeSource([b"block-1", b"block-2" + ERROR]), "db", "t", "SELECT 1",
+                               [("Destination", destination)], 4)
+    assert received == [b"block-1"]
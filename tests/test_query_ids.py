@@ -0,0 +1,18 @@
+import re
+
+from ch_migrate import QUERY_STAGE_SQL, stage_query_id
+
+STAGE = re.search(r"'(.*)'", QUERY_STAGE_SQL).group(1)
+
+
+def test_stage_follows_the_run_id():
+    ids = {
+        "read": stage_query_id("chm-1a2b3c4d-17", "read"),
+        "ins": stage_query_id("chm-1a2b3c4d-17", "ins", 5),
+        "raw": stage_query_id("chm-1a2b3c4d-17", "ins", "raw"),
+        "ddl": stage_query_id("chm-1a2b3c4d", "ddl"),
+    }
+    assert re.fullmatch(r"chm-1a2b3c4d-ins-17-5-[0-9a-f]{6}", ids["ins"])
+    assert re.fullmatch(r"chm-1a2b3c4d-ddl-[0-9a-f]{6}", ids["ddl"])
+    assert {kind: re.match(STAGE, query_id).group(1) for kind, query_id in ids.items()} == \
+        {"read": "read", "ins": "ins", "raw": "ins", "ddl": "ddl"}
@@ -0,0 +1,37 @@
+import pytest
+
+from ch_migrate import ReplicaPool
+
+REPLICAS = [("r1", {"host": "r1"}), ("r2", {"host": "r2"})]
+
+
+def _pool():
+    return ReplicaPool(REPLICAS, lambda params: params["host"], lambda *args: None)
+
+
+def test_failed_body_demotes_replica():
+    pool = _pool()
+    with pytest.raises(RuntimeError):
+        with pool.connection():
+            raise RuntimeError("read failed")
+    assert [host for host, _ in pool.replicas] == ["r2", "r1"]
+
+
+def test_acquired_connection_survives_unrelated_errors():
+    pool = _pool()
+    host, conn = pool.acquire()
+    try:
+        raise RuntimeError("source failed")
+    except RuntimeError:
+        pass
+    finally:
+        pool.release(host, conn)
+    assert [host for host, _ in pool.replicas] == ["r1", "r2"]
+    assert pool.acquire() == ("r1", "r1")
+
+
+def test_failed_release_demotes_replica():
+    pool = _pool()
+    host, conn = pool.acquire()
+    pool.release(host, conn, failed=True)
+    assert pool.acquire() == ("r2", "r2")
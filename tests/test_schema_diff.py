@@ -0,0 +1,57 @@
+from ch_migrate import CHMigrateApp
+
+ENGINE = "MergeTree PARTITION BY toYYYYMM(ts) ORDER BY id SETTINGS index_granularity = 8192"
+
+
+def table(engine=ENGINE, ttl="", columns=None, indexes=None):
+    return {"engine": engine, "keys": ("id", "toYYYYMM(ts)", "id"), "sorting_key": "id", "ttl": ttl,
+            "columns": columns or {"id": "`id` UInt64", "ts": "`ts` DateTime"}, "indexes": indexes or {}}
+
+
+def test_schema_alter_matching_tables():
+    assert CHMigrateApp._schema_alter(table(), table(), set()) == ([], [])
+
+
+def test_schema_alter_engine_arguments_force_recreate():
+    source = table("ReplacingMergeTree(version) ORDER BY id SETTINGS index_granularity = 8192")
+    dest = table("ReplacingMergeTree ORDER BY id SETTINGS index_granularity = 8192")
+    assert CHMigrateApp._schema_alter(source, dest, set()) is None
+    assert CHMigrateApp._schema_alter(table(), table(ENGINE.replace("8192", "1024")), set()) is None
+
+
+def test_schema_alter_accepts_engine_created_from_replicated_source():
+    source = table("ReplicatedMergeTree('/clickhouse/tables/{shard}/t', '{replica}') "
+                   "PARTITION BY toYYYYMM(ts) ORDER BY id SETTINGS index_granularity = 8192")
+    assert CHMigrateApp._schema_alter(source, table(), set()) == ([], [])
+    other_path = table(source["engine"].replace("/t'", "/t2'"))
+    assert CHMigrateApp._schema_alter(source, other_path, set()) is None
+
+
+def test_schema_alter_orders_index_column_and_ttl_changes():
+    source = table(ttl="ts + toIntervalDay(30)",
+                   columns={"id": "`id` UInt64", "ts": "`ts` DateTime", "name": "`name` String"},
+                   indexes={"ix": "INDEX `ix` name TYPE bloom_filter GRANULARITY 1"})
+    dest = table(columns={"id": "`id` UInt32", "ts": "`ts` DateTime", "old": "`old` String", "tag": "`tag` String"},
+                 indexes={"ix": "INDEX `ix` old TYPE bloom_filter GRANULARITY 1"})
+    commands, added = CHMigrateApp._schema_alter(source, dest, {"tag"})
+    assert added == ["name"]
+    assert commands == [
+        "DROP INDEX `ix`",
+        "MODIFY COLUMN `id` UInt64",
+        "ADD COLUMN `name` String AFTER `ts`",
+        "MODIFY TTL ts + toIntervalDay(30)",
+        "DROP COLUMN `old`",
+        "ADD INDEX `ix` name TYPE bloom_filter GRANULARITY 1",
+        "MATERIALIZE INDEX `ix`",
+    ]
+
+
+def test_table_ttl_skips_column_ttl():
+    ddl = ("CREATE TABLE db.t (`id` UInt64, `ts` DateTime, `v` String TTL ts + toIntervalDay(1))\n"
+           "ENGINE = MergeTree ORDER BY id\nTTL ts +\n    toIntervalDay(30)\nSETTINGS index_granularity = 8192")
+    assert CHMigrateApp._table_ttl(ddl) == "ts + toIntervalDay(30)"
+
+
+def test_table_ttl_empty_without_table_ttl():
+    ddl = "CREATE TABLE db.t (`id` UInt64, `v` String TTL now()) ENGINE = MergeTree ORDER BY id"
+    assert CHMigrateApp._table_ttl(ddl) == ""
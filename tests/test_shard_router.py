@@ -0,0 +1,68 @@
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import pytest
+
+from ch_migrate import CHMigrateApp, ShardRouter
+
+
+class FakeWriter:
+    def __init__(self):
+        self.blocks = []
+
+    def put(self, block):
+        self.blocks.append(block)
+
+
+def test_routes_rows_by_weighted_slots():
+    writers = [FakeWriter(), FakeWriter()]
+    # Shard 0 has weight 1, shard 1 weight 2
+    router = ShardRouter("Destination", writers, [0, 1, 1])
+    router.put([("a", 0), ("b", 1), ("c", 2), ("d", 3), ("e", 5)])
+    assert writers[0].blocks == [[("a",), ("d",)]]
+    assert writers[1].blocks == [[("b",), ("c",), ("e",)]]
+
+
+def test_columnar_routing_matches_row_routing():
+    keys = [7, 0, 4, 2, 9, 9]
+    names = list("abcdef")
+    row_writers, col_writers = [FakeWriter(), FakeWriter()], [FakeWriter(), FakeWriter()]
+    ShardRouter("Destination", row_writers, [0, 1, 1]).put(list(zip(names, keys)))
+    ShardRouter("Destination", col_writers, [0, 1, 1], column_oriented=True).put([names, keys])
+    for rows, columns in zip(row_writers, col_writers):
+        assert [name for (name,) in rows.blocks[0]] == list(columns.blocks[0][0])
+
+
+def test_negative_keys_arrive_cast_to_unsigned():
+    # The source sends toUInt64(key), so -1 is routed like the Distributed engine does (2**64 - 1)
+    writers = [FakeWriter(), FakeWriter(), FakeWriter()]
+    ShardRouter("Destination", writers, [0, 1, 2]).put([("neg", (-1) % 2 ** 64)])
+    assert (2 ** 64 - 1) % 3 != -1 % 3
+    assert [len(writer.blocks) for writer in writers] == [1, 0, 0]
+
+
+def layout_for(key_type):
+    client = SimpleNamespace(query=lambda sql: SimpleNamespace(result_rows=[("k", key_type)]))
+
+    @contextmanager
+    def connection():
+        yield [("Destination", client)]
+
+    app = SimpleNamespace(
+        _distributed_info=lambda c, db, table: {"cluster": "c", "sharding_key": "k", "db": "db", "table": "t_local"},
+        _cluster_shards=lambda c, cluster: [(1, 1, []), (2, 2, [])],
+        _shard_pools=lambda params, shards: ["pools"],
+        _log=lambda *args: None,
+    )
+    return CHMigrateApp._dest_shard_layout(app, SimpleNamespace(connection=connection), {}, "db", "t", {})
+
+
+def test_layout_casts_signed_keys_on_the_source():
+    layout = layout_for("Int64")
+    assert layout["key_expr"] == "toUInt64(k)"
+    assert layout["slots"] == [0, 1, 1]
+
+
+@pytest.mark.parametrize("key_type", ["Nullable(Int64)", "LowCardinality(Nullable(UInt32))", "String"])
+def test_layout_skips_keys_the_router_cannot_take(key_type):
+    assert layout_for(key_type) is None
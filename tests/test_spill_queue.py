@@ -0,0 +1,78 @@
+import json
+import os
+import threading
+
+from ch_migrate import SpillQueue
+
+
+def _segments(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(".seg"))
+
+
+def test_blocks_come_back_in_order(tmp_path):
+    spill = SpillQueue(str(tmp_path), 1024 * 1024)
+    for i in range(3):
+        spill.put([[i, i + 1], ["a", "b"]])
+    spill.close()
+    assert [spill.get() for _ in range(3)] == [(i, [[i, i + 1], ["a", "b"]]) for i in range(3)]
+    assert spill.get() is None
+
+
+def test_ack_persists_cursor_and_rewind_resumes_there(tmp_path):
+    spill = SpillQueue(str(tmp_path), 1024 * 1024)
+    for i in range(3):
+        spill.put([[i]])
+    spill.close()
+    assert spill.get()[0] == 0
+    spill.ack()
+    assert spill.get()[0] == 1
+    assert spill.get()[0] == 2
+
+    with open(tmp_path / "cursor.json", encoding="utf-8") as f:
+        assert json.load(f)["block"] == 1
+    spill.rewind()
+    assert spill.get() == (1, [[1]])
+    assert spill.get() == (2, [[2]])
+    assert spill.get() is None
+
+
+def test_rewind_without_cursor_starts_from_the_beginning(tmp_path):
+    spill = SpillQueue(str(tmp_path), 1024 * 1024)
+    spill.put([[0]])
+    spill.close()
+    spill.get()
+    spill.rewind()
+    assert spill.get() == (0, [[0]])
+
+
+def test_acknowledged_segments_are_deleted(tmp_path):
+    spill = SpillQueue(str(tmp_path), 1024 * 1024, segment_bytes=1)
+    for i in range(3):
+        spill.put([[i]])
+    spill.close()
+    assert len(_segments(tmp_path)) == 3
+    spill.get()
+    spill.get()
+    spill.ack()
+    assert _segments(tmp_path) == ["000001.seg", "000002.seg"]
+    spill.get()
+    spill.ack()
+    assert spill.get() is None
+    spill.remove()
+    assert not os.path.exists(tmp_path)
+
+
+def test_put_waits_for_ack_while_full(tmp_path):
+    spill = SpillQueue(str(tmp_path), 400, segment_bytes=1)
+    spill.put([[os.urandom(300)]])
+    blocked = threading.Thread(target=spill.put, args=([[os.urandom(300)]],))
+    blocked.start()
+    blocked.join(0.3)
+    assert blocked.is_alive()
+
+    spill.get()
+    spill.ack()
+    blocked.join(2)
+    assert not blocked.is_alive()
+    spill.close()
+    assert spill.get()[0] == 1
@@ -0,0 +1,31 @@
+import threading
+import time
+
+from ch_migrate import TokenBucket
+
+
+def test_token_bucket_unlimited_never_waits():
+    bucket = TokenBucket()
+    start = time.monotonic()
+    bucket.consume(10 ** 9)
+    assert time.monotonic() - start < 0.05
+
+
+def test_token_bucket_overdraw_waits_for_refill():
+    bucket = TokenBucket(1000)
+    start = time.monotonic()
+    bucket.consume(1000)  # the initial second of budget
+    assert time.monotonic() - start < 0.05
+    bucket.consume(200)
+    assert 0.15 <= time.monotonic() - start < 0.5
+
+
+def test_token_bucket_rate_change_releases_waiters():
+    bucket = TokenBucket(10)
+    bucket.consume(10)
+    done = threading.Event()
+    waiter = threading.Thread(target=lambda: (bucket.consume(1000), done.set()), daemon=True)
+    waiter.start()
+    assert not done.wait(0.2)
+    bucket.set_rate(0)
+    assert done.wait(1.0)
@@ -0,0 +1,77 @@
+import pytest
+
+from ch_migrate import CHMigrateApp
+
+DDL = """CREATE TABLE db.t
+(
+    `id` UInt64,
+    `user_id` UInt64 COMMENT 'user_id of the owner',
+    `ts` DateTime DEFAULT now(),
+    `day` Date MATERIALIZED toDate(ts),
+    `secret` String,
+    INDEX ix_user user_id TYPE minmax GRANULARITY 1
+)
+ENGINE = ReplacingMergeTree(ts)
+PARTITION BY toYYYYMM(ts)
+ORDER BY (user_id,
+    id)
+TTL ts + toIntervalDay(30) -- ts based
+SETTINGS index_granularity = 8192
+COMMENT 'ts and user_id'"""
+
+COLUMNS = [{"name": name, "type": col_type} for name, col_type in [
+    ("id", "UInt64"), ("user_id", "UInt64"), ("ts", "DateTime"), ("day", "Date"), ("secret", "String")]]
+
+
+def test_hash_expr_follows_base_type():
+    assert CHMigrateApp._hash_expr("x", "LowCardinality(Nullable(String))") == \
+        "CAST(hex(SHA256(x)) AS LowCardinality(Nullable(String)))"
+    assert CHMigrateApp._hash_expr("x", "FixedString(8)") == \
+        "CAST(toFixedString(substring(hex(SHA256(x)), 1, 8), 8) AS FixedString(8))"
+    assert CHMigrateApp._hash_expr("x", "UInt32") == "CAST(sipHash64(x) AS UInt32)"
+
+
+def test_hash_expr_rejects_unhashable_types():
+    assert CHMigrateApp._hash_expr("x", "DateTime") is None
+    assert CHMigrateApp._hash_expr("x", "Float64") is None
+    assert CHMigrateApp._hash_expr("x", "FixedString(65)") is None
+
+
+def test_transform_select_applies_spec():
+    spec = {"drop": ["secret"], "rename": {"user_id": "uid"}, "hash": ["user_id"], "cast": {"id": "Int64"},
+            "null": ["ts"]}
+    columns = [("id", "UInt64"), ("user_id", "UInt64"), ("ts", "DateTime"), ("secret", "String")]
+    assert CHMigrateApp._transform_select("SELECT * FROM db.t", spec, columns) == (
+        "SELECT CAST(__src.`id` AS Int64) AS `id`, CAST(sipHash64(__src.`user_id`) AS UInt64) AS `uid`, "
+        "defaultValueOfArgumentType(__src.`ts`) AS `ts` FROM (SELECT * FROM db.t) AS __src")
+
+
+def test_transform_to_ddl_renames_whole_identifiers_only():
+    spec = {"rename": {"user_id": "uid", "ts": "event_time"}, "drop": ["secret"], "cast": {"id": "Int64"}}
+    assert CHMigrateApp._apply_transform_to_ddl(DDL, spec, COLUMNS) == """CREATE TABLE db.t
+(
+    `id` Int64,
+    `uid` UInt64 COMMENT 'user_id of the owner',
+    `event_time` DateTime DEFAULT now(),
+    `day` Date MATERIALIZED toDate(`event_time`),
+    INDEX ix_user `uid` TYPE minmax GRANULARITY 1
+)
+ENGINE = ReplacingMergeTree(`event_time`)
+PARTITION BY toYYYYMM(`event_time`)
+ORDER BY (`uid`,
+    id)
+TTL `event_time` + toIntervalDay(30) -- ts based
+SETTINGS index_granularity = 8192
+COMMENT 'ts and user_id'"""
+
+
+def test_transform_to_ddl_drops_last_definition():
+    ddl = "CREATE TABLE db.t\n(\n    `id` UInt64,\n    `secret` String\n)\nENGINE = MergeTree ORDER BY id"
+    columns = [{"name": "id", "type": "UInt64"}, {"name": "secret", "type": "String"}]
+    assert CHMigrateApp._apply_transform_to_ddl(ddl, {"keep": ["id"]}, columns) == \
+        "CREATE TABLE db.t\n(\n    `id` UInt64\n)\nENGINE = MergeTree ORDER BY id"
+
+
+def test_transform_to_ddl_rejects_key_on_removed_column():
+    with pytest.raises(ValueError, match="user_id"):
+        CHMigrateApp._apply_transform_to_ddl(DDL, {"drop": ["user_id"]}, COLUMNS)
@@ -0,0 +1,62 @@
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+from ch_migrate import CHMigrateApp
+
+SELECT = "SELECT * FROM `db`.`events_local`"
+
+
+class FakeStream:
+    def __init__(self, column_names, blocks):
+        self.source = SimpleNamespace(column_names=column_names)
+        self._blocks = iter(blocks)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._blocks)
+
+
+class FakeSource:
+    def __init__(self, blocks):
+        self.blocks = blocks
+
+    @contextmanager
+    def query_column_block_stream(self, query, settings=None):
+        yield FakeStream(["id", "name"], self.blocks)
+
+
+class FakeDestination:
+    def __init__(self):
+        self.tokens = []
+
+    def insert(self, table, data, column_names, settings=None, column_oriented=False):
+        self.tokens.append(settings["insert_deduplication_token"])
+
+
+def _copy(unit_key):
+    app = CHMigrateApp.__new__(CHMigrateApp)
+    app._log = lambda *args, **kwargs: None
+    destination = FakeDestination()
+    source = FakeSource([[[1, 2], ["a", "b"]], [[3], ["c"]]])
+    rows = app._copy_table(source, "db", "events", SELECT, [("Destination", destination)], 4,
+                           unit_key=unit_key)
+    assert rows == 3
+    return destination.tokens
+
+
+def test_shard_units_get_different_tokens():
+    shard_1 = _copy(CHMigrateApp._unit_key("source", 1, None))
+    shard_2 = _copy(CHMigrateApp._unit_key("source", 2, None))
+    assert len(shard_1) == len(shard_2) == 2
+    assert not set(shard_1) & set(shard_2)
+
+
+def test_same_unit_repeats_its_tokens():
+    key = CHMigrateApp._unit_key("source", 1, "id < 100")
+    assert _copy(key) == _copy(key)
+
+
+def test_sources_get_different_tokens():
+    assert not set(_copy(CHMigrateApp._unit_key("a", 0, None))) & set(_copy(CHMigrateApp._unit_key("b", 0, None)))